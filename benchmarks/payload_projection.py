@@ -0,0 +1,128 @@
+import argparse
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship, sessionmaker
+
+import sql
+from database import Database, GENDER_CODES
+from pipeline.scoring import Scoring
+
+# ORM mapping over the same tables, to compare against the projection Scoring uses
+Base = declarative_base(metadata=sql.metadata)
+
+
+class Station(Base):
+    __table__ = sql.stations
+
+
+class Trip(Base):
+    __table__ = sql.trips
+    start_station = relationship(Station, foreign_keys=[sql.trips.c.start_station_id])
+    end_station = relationship(Station, foreign_keys=[sql.trips.c.end_station_id])
+
+
+def populate(engine: sa.engine.Engine, trip_count: int, station_count: int = 400):
+    start = datetime(2020, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(sql.stations.insert(), [{
+            'id': str(station_id),
+            'name': f'Station {station_id}',
+            'latitude': 42.35,
+            'longitude': -71.06,
+            'region_id': '10',
+            'region_name': 'Boston',
+            'capacity': 15,
+            'has_kiosk': True,
+        } for station_id in range(station_count)])
+        conn.execute(sql.trips.insert(), [{
+            'id': trip_id,
+            'trip_duration': 600.0,
+            'start_station_id': str(trip_id % station_count),
+            'end_station_id': str((trip_id + 1) % station_count),
+            'start_time': start + timedelta(seconds=trip_id % 60),
+            'stop_time': start + timedelta(seconds=trip_id % 60 + 600),
+            'bike_id': trip_id % 5000,
+            'user_type': 'Subscriber',
+            'user_birth_year': 1980 + trip_id % 30,
+            'user_gender': ('Male', 'Female', 'Other')[trip_id % 3],
+            'submitted_actual': False,
+        } for trip_id in range(trip_count)])
+    return start, start + timedelta(minutes=1)
+
+
+def orm_payload(engine: sa.engine.Engine, start_time_range, limit):
+    session = sessionmaker(bind=engine)()
+    try:
+        trips = session.query(Trip).join(Station, Trip.start_station_id == Station.id).filter(
+            Trip.start_time.between(*start_time_range),
+            Trip.predicted_trip_duration.is_(None),
+        ).limit(limit).all()
+        rows = [(
+            trip.id,
+            trip.bike_id,
+            trip.user_birth_year,
+            GENDER_CODES.get(trip.user_gender, GENDER_CODES['Other']),
+            trip.start_station.id,
+            trip.start_station.name,
+            trip.end_station.name,
+            trip.start_time,
+            trip.start_station.capacity,
+            trip.start_station.has_kiosk,
+            trip.start_station.region_id,
+            trip.user_type,
+            trip.start_station.latitude,
+            trip.start_station.longitude,
+            trip.end_station.latitude,
+            trip.end_station.longitude,
+        ) for trip in trips]
+        return Scoring._assemble_prediction_payloads(rows)
+    finally:
+        session.close()
+
+
+def projection_payload(engine: sa.engine.Engine, start_time_range, limit):
+    with Database(engine) as db:
+        rows = db.get_prediction_rows(start_time_range, without_predictions=True, limit=limit)
+    return Scoring._assemble_prediction_payloads(rows)
+
+
+def registry_payload(engine: sa.engine.Engine, start_time_range, limit):
+    with Database(engine) as db:
+        rows = Scoring.prediction_rows(db, start_time_range, limit)
+    return Scoring._assemble_prediction_payloads(rows)
+
+
+def measure(func, *args, repeat: int = 5) -> (float, list):
+    timings, result = [], None
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        result = func(*args)
+        timings.append(time.perf_counter() - started_at)
+    return min(timings), result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare ORM and Core payload assembly for scoring.')
+    parser.add_argument('--trips', type=int, default=10000)
+    parser.add_argument('--database-url', default=None, help='defaults to a temporary SQLite database')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = sa.create_engine(args.database_url or f'sqlite:///{Path(directory, "bench.sqlite")}')
+        sql.metadata.create_all(engine, tables=[sql.stations, sql.trips])
+        start_time_range = populate(engine, args.trips)
+
+        orm_time, orm_result = measure(orm_payload, engine, start_time_range, args.trips)
+        core_time, core_result = measure(projection_payload, engine, start_time_range, args.trips)
+        registry_time, registry_result = measure(registry_payload, engine, start_time_range, args.trips)
+        assert orm_result == core_result == registry_result, 'payloads differ'
+
+        print(f'rows: {len(core_result)}')
+        print(f'orm:        {orm_time * 1000:8.1f}ms')
+        print(f'projection: {core_time * 1000:8.1f}ms ({orm_time / core_time:.1f}x faster)')
+        print(f'registry:   {registry_time * 1000:8.1f}ms ({orm_time / registry_time:.1f}x faster)')
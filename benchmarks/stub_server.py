@@ -0,0 +1,87 @@
+import argparse
+import asyncio
+import logging
+import random
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class StubDataRobotServer:
+    # stands in for the DataRobot prediction and actuals endpoints, with configurable latency and
+    # failure rate, so scoring and actuals submission can be exercised without the real service;
+    # `errors` queues statuses to answer the next requests with, ahead of the random failures
+    def __init__(self, latency: float = 0.05, failure_rate: float = 0.0, prediction: float = 600.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.prediction = prediction
+        self.prediction_requests = 0
+        self.predicted_rows = 0
+        self.actuals_requests = 0
+        self.actual_rows = 0
+        self.errors = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.app = web.Application()
+        self.app.router.add_post('/deployments/{deployment_id}/predictions', self.predictions)
+        self.app.router.add_post('/deployments/{deployment_id}/actuals/fromJSON/', self.actuals)
+        self._runner: web.AppRunner = None
+
+    async def _simulate(self) -> web.Response:
+        # the error response to answer with, None to answer normally
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        if self.errors:
+            return web.json_response({'message': 'stub error'}, status=self.errors.pop(0))
+        if random.random() < self.failure_rate:
+            return web.json_response({'message': 'stub failure'}, status=503)
+        return None
+
+    async def predictions(self, request: web.Request) -> web.Response:
+        error = await self._simulate()
+        if error is not None:
+            return error
+        rows = await request.json()
+        self.prediction_requests += 1
+        self.predicted_rows += len(rows)
+        return web.json_response({'data': [
+            {'rowId': index, 'prediction': self.prediction} for index, _ in enumerate(rows)
+        ]})
+
+    async def actuals(self, request: web.Request) -> web.Response:
+        error = await self._simulate()
+        if error is not None:
+            return error
+        body = await request.json()
+        self.actuals_requests += 1
+        self.actual_rows += len(body.get('data', []))
+        return web.json_response({'status': 'accepted'}, status=202)
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8080) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f'http://{host}:{port}'
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stub DataRobot prediction and actuals server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+    server = StubDataRobotServer(latency=args.latency, failure_rate=args.failure_rate)
+    web.run_app(server.app, host=args.host, port=args.port)
@@ -1,7 +1,48 @@
 import json
+import typing
+
+import numpy as np
 import pandas as pd
 
 
+def trip_ids(bike_ids, start_times, start_station_ids) -> np.ndarray:
+    # signed 64 bit ids hashed from the natural key of a trip, so the same trip gets the same id
+    # in every run, process and file; start times are reduced to whole microseconds first so the
+    # hash does not depend on the datetime resolution pandas picks
+    start_times = pd.to_datetime(pd.Series(start_times).reset_index(drop=True))
+    key = pd.DataFrame({
+        'bike_id': pd.to_numeric(pd.Series(bike_ids).reset_index(drop=True)).astype('int64'),
+        'start_time': (start_times - pd.Timestamp(0)) // pd.Timedelta(microseconds=1),
+        'start_station_id': pd.Series(start_station_ids).reset_index(drop=True).astype(str),
+    })
+    return pd.util.hash_pandas_object(key, index=False).to_numpy().view(np.int64)
+
+
+def chunk_size_for_memory(file_path, max_memory: int, sample_rows: int = 10000) -> int:
+    # estimate how many rows of the csv fit in `max_memory` bytes once parsed, from a sample
+    position = file_path.tell() if hasattr(file_path, 'seek') else None
+    sample = pd.read_csv(file_path, nrows=sample_rows)
+    if position is not None:
+        file_path.seek(position)
+    if sample.empty:
+        return sample_rows
+    bytes_per_row = sample.memory_usage(deep=True).sum() / len(sample)
+    return max(int(max_memory / bytes_per_row), 1)
+
+
+def read_csv_chunks(file_path, chunk_size: int = None, max_memory: int = None,
+                    skip_rows: int = 0) -> typing.Iterator[pd.DataFrame]:
+    # the whole csv as one frame, or in chunks of `chunk_size` rows, or sized from a `max_memory`
+    # ceiling in bytes; the first `skip_rows` data rows are skipped, the header line is kept
+    if chunk_size is None and max_memory is not None:
+        chunk_size = chunk_size_for_memory(file_path, max_memory)
+    skiprows = range(1, skip_rows + 1) if skip_rows else None
+    if chunk_size is None:
+        yield pd.read_csv(file_path, skiprows=skiprows)
+    else:
+        yield from pd.read_csv(file_path, skiprows=skiprows, chunksize=chunk_size)
+
+
 class JSONDataSource:
     def __init__(self, file_path):
         self._cache = {}
@@ -44,14 +85,6 @@ class Stations(JSONDataSource):
     def all(self):
         return self._cache.values()
 
-    def to_dataframe(self):
-        data = {int(station_id): {
-            'station_region_id': str(station['region_id']),
-            'station_capacity': str(station['capacity']),
-            'station_has_kiosk': station['has_kiosk'],
-        } for station_id, station in self._cache.items()}
-        return pd.DataFrame.from_dict(data, orient='index')
-
 
 class Trips:
     def __init__(self, file_path):
@@ -1,147 +1,247 @@
 import logging
-from uuid import uuid4
+from datetime import datetime, timedelta
 
-from sqlalchemy import *
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
-from sqlalchemy.orm import sessionmaker, Session
+import sqlalchemy as sa
 
-from data_sources import Stations, Regions, Trips
+import sql
+from sql import DatabaseMixin
 
-engine = create_engine('sqlite:///data.sqlite')
-Base = declarative_base()
 logger = logging.getLogger(__name__)
 
-
-class Station(Base):
-    __tablename__ = 'stations'
-
-    id = Column(Integer, primary_key=True)
-    external_id = Column(String(50), nullable=False)
-    name = Column(String(200), nullable=False)
-    short_name = Column(String(16), nullable=False)
-    latitudes = Column(Float, nullable=False)
-    longitudes = Column(Float, nullable=False)
-    region_id = Column(Float)
-    region_name = Column(String(16))
-    capacity = Column(Integer)
-    has_kiosk = Column(Boolean)
-
-
-class Trip(Base):
-    __tablename__ = 'trips'
-
-    id = Column(String(50), primary_key=True)
-    trip_duration = Column(Float)
-    predicted_trip_duration = Column(Float)
-    start_time = Column(DateTime)
-    start_station_id = Column(Integer, ForeignKey('stations.id'))
-    start_station_name = Column(String)
-    end_station_name = Column(String)
-    bike_id = Column(Integer)
-    user_type = Column(String)
-    birth_year = Column(Integer)
-    gender = Column(Integer)
-    actual_sent = Column(Boolean)
-
-    start_station = relationship('Station')
+# the prediction model was trained on the raw gender codes of the trip csv files
+GENDER_CODES = {'Male': 0, 'Female': 1, 'Other': 2}
 
 
 class Database:
-    def __init__(self):
-        self.session: Session
+    # repository over the tables in `sql`, shared by scoring, actuals and exports; a `with` block
+    # is one transaction on a connection checked out from the process-wide pool
+    def __init__(self, engine: sa.engine.Engine = None):
+        self.engine = engine
+        self.connection: sa.engine.Connection = None
+        self._transaction = None
+
+    def get_prediction_rows(self, start_time_range, without_predictions=True, limit=100) -> [tuple]:
+        # read-only projection of the prediction payload columns and the station coordinates
+        args = self._trip_data_filter(start_time_range, without_predictions)
+        statement = sa.select([
+            sql.trips.c.id,
+            sql.trips.c.bike_id,
+            sql.trips.c.user_birth_year,
+            sa.case(GENDER_CODES, value=sql.trips.c.user_gender, else_=GENDER_CODES['Other']),
+            sql.trips.c.start_station_id,
+            sql.stations.c.name,
+            sql.end_stations.c.name,
+            sql.trips.c.start_time,
+            sql.stations.c.capacity,
+            sql.stations.c.has_kiosk,
+            sql.stations.c.region_id,
+            sql.trips.c.user_type,
+            sql.stations.c.latitude,
+            sql.stations.c.longitude,
+            sql.end_stations.c.latitude,
+            sql.end_stations.c.longitude,
+        ]).select_from(
+            self._trip_data_from().outerjoin(
+                sql.end_stations, sql.trips.c.end_station_id == sql.end_stations.c.id
+            )
+        ).where(sa.and_(*args)).limit(limit)
+        return self.connection.execute(statement).fetchall()
+
+    def get_prediction_trip_rows(self, start_time_range, without_predictions=True, limit=100) -> [tuple]:
+        # the trip columns of get_prediction_rows only, station attributes come from the registry
+        args = self._trip_data_filter(start_time_range, without_predictions)
+        statement = sa.select([
+            sql.trips.c.id,
+            sql.trips.c.bike_id,
+            sql.trips.c.user_birth_year,
+            sa.case(GENDER_CODES, value=sql.trips.c.user_gender, else_=GENDER_CODES['Other']),
+            sql.trips.c.start_station_id,
+            sql.trips.c.end_station_id,
+            sql.trips.c.start_time,
+            sql.trips.c.user_type,
+        ]).select_from(self._trip_data_from()).where(sa.and_(*args)).limit(limit)
+        return self.connection.execute(statement).fetchall()
+
+    def count_trip_data(self, start_time_range, without_predictions=True) -> int:
+        args = self._trip_data_filter(start_time_range, without_predictions)
+        statement = sa.select([sa.func.count(sql.trips.c.id)]).select_from(
+            self._trip_data_from()
+        ).where(sa.and_(*args))
+        return self.connection.execute(statement).scalar()
 
     @staticmethod
-    def create_table():
-        Base.metadata.create_all(engine)
+    def _trip_data_from() -> sa.sql.Join:
+        # trips without a known start station cannot be scored, so they are not backlog either
+        return sql.trips.join(sql.stations, sql.trips.c.start_station_id == sql.stations.c.id)
 
     @staticmethod
-    def create_index():
-        pass
-
-    def update_stations(self, stations: Stations, regions: Regions):
-        for item in stations.all:
-            station = Station(
-                id=int(item['station_id']),
-                external_id=item['external_id'],
-                name=item['name'],
-                short_name=item['short_name'],
-                latitudes=item['lat'],
-                longitudes=item['lon'],
-                region_id=item['region_id'],
-                region_name=regions[item['region_id']],
-                capacity=item['capacity'],
-                has_kiosk=item['has_kiosk']
-            )
-            self.session.merge(station)
-
-    def update_trip_data(self, trips: Trips):
-        if self._trip_exists_with_start_date(trips.first_trip_start_time):
-            return
-
-        batch = []
-        for index, item in trips.dataframe.iterrows():
-            trip = Trip(
-                id=str(uuid4()),
-                trip_duration=item['trip_duration'],
-                start_time=item['start_time'],
-                start_station_id=item['start_station_id'],
-                start_station_name=item['start_station_name'],
-                end_station_name=item['end_station_name'],
-                bike_id=item['bike_id'],
-                user_type=item['user_type'],
-                birth_year=item['birth_year'],
-                gender=item['gender'],
-            )
-            batch.append(trip)
-            if index % 1000 == 0:
-                self.session.add_all(batch)
-                batch = []
-
-    def get_trip_data(self, start_time_range, without_predictions=True, limit=100) -> [Trip]:
-        args = [Trip.start_time.between(start_time_range[0], start_time_range[1])]
+    def _trip_data_filter(start_time_range, without_predictions=True) -> list:
+        args = [sql.trips.c.start_time.between(start_time_range[0], start_time_range[1])]
         if without_predictions is True:
-            args.append(Trip.predicted_trip_duration.is_(None))
-        return self.session.query(Trip).join(Station).filter(*args).limit(limit).all()
+            args.append(sql.trips.c.predicted_trip_duration.is_(None))
+        return args
 
-    def update_predicted_trip_duration(self, updates):
+    def update_predicted_trip_duration(self, updates, start_time_range=None):
+        # with the start time range of the trips only their partitions are scanned
         if not updates:
             return
-        self.session.query(Trip).filter(
-            Trip.id.in_(updates)
-        ).update({
-            Trip.predicted_trip_duration: case(
-                updates, value=Trip.id
-            )
-        }, synchronize_session=False)
-
-    def get_actuals(self, limit=1000):
-        return self.session.query(Trip).filter(
-            Trip.predicted_trip_duration.isnot(None),
-            Trip.actual_sent.isnot(True)
-        ).limit(limit).all()
-
-    def mark_actuals_submitted(self, trip_ids):
-        self.session.query(Trip).filter(
-            Trip.id.in_(trip_ids)
-        ).update({
-            Trip.actual_sent: True
-        }, synchronize_session=False)
-
-    def _trip_exists_with_start_date(self, start_time):
-        trip = self.session.query(Trip).filter_by(start_time=start_time).first()
-        return trip is not None
+        args = [sql.trips.c.id.in_(updates)]
+        if start_time_range is not None:
+            args.append(sql.trips.c.start_time.between(start_time_range[0], start_time_range[1]))
+        self.connection.execute(sql.trips.update().where(
+            sa.and_(*args)
+        ).values(
+            predicted_trip_duration=sa.case(updates, value=sql.trips.c.id)
+        ))
+
+    def enqueue_actuals(self, batch_id: str, limit=1000, lease=300) -> [int]:
+        # moves up to `limit` predicted trips into a new outbox batch; rows another worker is
+        # enqueueing are skipped, so concurrent submitters never put a trip in two batches.
+        # the batch starts claimed by the caller for `lease` seconds. the conditions are the ones
+        # of the partial index ix_trips_actuals_pending, spelled the same for the planner to use it
+        statement = sa.select([sql.trips.c.id]).where(sa.and_(
+            sql.trips.c.predicted_trip_duration.isnot(None),
+            sa.not_(sql.trips.c.submitted_actual),
+            sql.trips.c.actuals_batch_id.is_(None),
+        )).order_by(sql.trips.c.id).limit(limit).with_for_update(skip_locked=True)
+        trip_ids = [row.id for row in self.connection.execute(statement)]
+        if not trip_ids:
+            return []
+
+        now = datetime.utcnow()
+        self.connection.execute(sql.actuals_outbox.insert().values(
+            batch_id=batch_id,
+            trip_ids=trip_ids,
+            status='pending',
+            attempts=1,
+            next_attempt_at=now + timedelta(seconds=lease),
+            created_at=now,
+            updated_at=now,
+        ))
+        self.connection.execute(sql.trips.update().where(
+            sql.trips.c.id.in_(trip_ids)
+        ).values(
+            actuals_batch_id=batch_id
+        ))
+        return trip_ids
+
+    def claim_actuals_batch(self, lease=300) -> tuple:
+        # claims the oldest due batch for `lease` seconds, a worker that dies mid-request leaves
+        # the batch to be picked up again once the lease runs out
+        now = datetime.utcnow()
+        statement = sa.select([
+            sql.actuals_outbox.c.batch_id,
+            sql.actuals_outbox.c.trip_ids,
+            sql.actuals_outbox.c.attempts,
+        ]).where(sa.and_(
+            sql.actuals_outbox.c.status == 'pending',
+            sql.actuals_outbox.c.next_attempt_at <= now,
+        )).order_by(sql.actuals_outbox.c.next_attempt_at).limit(1).with_for_update(skip_locked=True)
+        batch = self.connection.execute(statement).first()
+        if batch is None:
+            return None
+
+        self.connection.execute(sql.actuals_outbox.update().where(
+            sql.actuals_outbox.c.batch_id == batch.batch_id
+        ).values(
+            attempts=batch.attempts + 1,
+            next_attempt_at=now + timedelta(seconds=lease),
+            updated_at=now,
+        ))
+        return batch.batch_id, list(batch.trip_ids), batch.attempts + 1
+
+    def get_actuals(self, trip_ids) -> [tuple]:
+        statement = sa.select([sql.trips.c.id, sql.trips.c.trip_duration]).where(
+            sql.trips.c.id.in_(trip_ids)
+        ).order_by(sql.trips.c.id)
+        return self.connection.execute(statement).fetchall()
+
+    def mark_actuals_sent(self, batch_id: str):
+        # the outbox status and the trips flip together, a batch is only ever accounted once
+        updated = self.connection.execute(sql.actuals_outbox.update().where(sa.and_(
+            sql.actuals_outbox.c.batch_id == batch_id,
+            sql.actuals_outbox.c.status == 'pending',
+        )).values(
+            status='sent',
+            last_error=None,
+            updated_at=datetime.utcnow(),
+        )).rowcount
+        if updated:
+            self.connection.execute(sql.trips.update().where(
+                sql.trips.c.actuals_batch_id == batch_id
+            ).values(
+                submitted_actual=True
+            ))
+            self.connection.execute(sql.merge_error_aggregates(
+                sa.select([sql.trips]).where(sql.trips.c.actuals_batch_id == batch_id).alias('batch')
+            ))
+        return updated > 0
+
+    def mark_actuals_failed(self, batch_id: str, error: str, retry_at: datetime = None):
+        # without a retry time the batch is dead-lettered, its trips stay out of new batches
+        values = {'last_error': error, 'updated_at': datetime.utcnow()}
+        if retry_at is None:
+            values['status'] = 'dead'
+        else:
+            values['next_attempt_at'] = retry_at
+        self.connection.execute(sql.actuals_outbox.update().where(sa.and_(
+            sql.actuals_outbox.c.batch_id == batch_id,
+            sql.actuals_outbox.c.status == 'pending',
+        )).values(**values))
+
+    def next_actuals_attempt(self) -> datetime:
+        # when the next pending batch falls due, None without pending batches
+        statement = sa.select([sa.func.min(sql.actuals_outbox.c.next_attempt_at)]).where(
+            sql.actuals_outbox.c.status == 'pending'
+        )
+        return self.connection.execute(statement).scalar()
+
+    def requeue_dead_actuals(self, batch_ids: [str] = None) -> int:
+        # dead-lettered batches (all of them, or `batch_ids`) are due again with a fresh set of
+        # attempts; their trips never left the batch, so nothing is enqueued twice
+        args = [sql.actuals_outbox.c.status == 'dead']
+        if batch_ids:
+            args.append(sql.actuals_outbox.c.batch_id.in_(batch_ids))
+        now = datetime.utcnow()
+        return self.connection.execute(sql.actuals_outbox.update().where(sa.and_(*args)).values(
+            status='pending',
+            attempts=0,
+            next_attempt_at=now,
+            updated_at=now,
+        )).rowcount
+
+    def count_actuals_batches(self) -> dict:
+        statement = sa.select([
+            sql.actuals_outbox.c.status, sa.func.count(sql.actuals_outbox.c.batch_id)
+        ]).group_by(sql.actuals_outbox.c.status)
+        return dict(self.connection.execute(statement).fetchall())
+
+    def get_trip_aggregates(self, hour: int = None, start_station_id=None, user_type=None) -> [tuple]:
+        # reads the precomputed aggregates instead of scanning trips, one row per station, hour of
+        # day and user type; see sql.histogram_percentile for percentiles of the histograms
+        args = []
+        if hour is not None:
+            args.append(sql.trip_aggregates.c.hour == hour)
+        if start_station_id is not None:
+            args.append(sql.trip_aggregates.c.start_station_id == start_station_id)
+        if user_type is not None:
+            args.append(sql.trip_aggregates.c.user_type == user_type)
+        statement = sa.select([sql.trip_aggregates]).where(sa.and_(*args)).order_by(
+            sql.trip_aggregates.c.start_station_id, sql.trip_aggregates.c.hour, sql.trip_aggregates.c.user_type
+        )
+        return self.connection.execute(statement).fetchall()
 
     def __enter__(self):
-        Session = sessionmaker(bind=engine)
-        self.session = Session()
+        engine = self.engine or DatabaseMixin.create_engine()
+        self.connection = engine.connect()
+        self._transaction = self.connection.begin()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         try:
-            self.session.commit()
-        except:
-            self.session.rollback()
-            raise
+            if exc_type is None:
+                self._transaction.commit()
+            else:
+                self._transaction.rollback()
         finally:
-            self.session.close()
+            self.connection.close()
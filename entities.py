@@ -13,6 +13,7 @@ class Station:
     name: str
     latitude: float
     longitude: float
+    region_id: str = None
     region_name: str = None
     capacity: int = None
     has_kiosk: bool = None
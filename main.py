@@ -1,57 +1,103 @@
+import argparse
 import asyncio
 import logging
+import os
+import signal
+from datetime import datetime
 
 import aiohttp
 
 import sql
-from pipeline import TrainingData, Scoring, Actuals, StationDataImporter, TripDataImporter
-from pathlib import Path
+from pipeline import (
+    TrainingData, Scoring, Actuals, StationDataImporter, TripDataImporter, ParallelTripImporter, LoopLagMonitor,
+    AdaptiveScheduler,
+)
+from pipeline.base import run_blocking
 import zipfile
 logger = logging.getLogger(__name__)
 
 
 def export_training_data():
-    TrainingData().process()
+    TrainingData().process(output_format=os.getenv('TRAINING_OUTPUT_FORMAT', 'csv'))
 
 
-async def import_data():
+async def import_data(concurrency=2, workers=None):
+    # with worker processes, parsing and transforming scale with the available cores
+    if workers:
+        await ParallelTripImporter('./data/data.zip', workers=workers).run()
+        return
+
     await StationDataImporter().run()
 
-    with zipfile.ZipFile('./data/data.zip', 'r') as file:
-        file.extractall('./data')
+    # csv members are parsed straight out of the archive, `concurrency` of them at a time
+    semaphore = asyncio.Semaphore(concurrency)
 
-    for path in sorted(Path('./data').iterdir()):
-        if not path.name.endswith('.csv'):
-            continue
-        await TripDataImporter(path).run()
-        path.unlink()
+    async def import_member(file: zipfile.ZipFile, member: zipfile.ZipInfo):
+        async with semaphore:
+            await TripDataImporter.from_zip_member(file, member, chunk_size=100000).run()
+
+    with zipfile.ZipFile('./data/data.zip', 'r') as file:
+        members = sorted(
+            (member for member in file.infolist() if member.filename.endswith('.csv')),
+            key=lambda member: member.filename,
+        )
+        await asyncio.gather(*[import_member(file, member) for member in members])
 
 
 async def score():
     async with aiohttp.ClientSession() as session:
-        scoring = Scoring(session)
-        while True:
-            try:
-                await scoring.predict()
-                await asyncio.sleep(10)
-            except Exception as e:
-                logger.error(e)
-                await asyncio.sleep(100)
+        await AdaptiveScheduler(Scoring(session)).run()
 
 
-async def actual_submit():
+async def actual_submit(idle_delay=600):
     async with aiohttp.ClientSession() as session:
-        actuals = Actuals(session)
+        actuals = Actuals(
+            session,
+            batch_size=int(os.getenv('ACTUALS_BATCH_SIZE', 1000)),
+            max_attempts=int(os.getenv('ACTUALS_MAX_ATTEMPTS', 8)),
+        )
         while True:
             try:
-                await actuals.upload()
-                await asyncio.sleep(600)
+                # keep draining at full speed while there is a backlog; once it is empty, sleep until
+                # the next retry falls due, at most `idle_delay`. dead-lettered batches are retried
+                # with `python main.py --requeue-dead-actuals`
+                if await actuals.upload() == 0:
+                    logger.info(f'Actuals - outbox batches: {await run_blocking(actuals.outbox_status)}')
+                    next_attempt_at = await run_blocking(actuals.next_attempt_at)
+                    delay = idle_delay
+                    if next_attempt_at is not None:
+                        delay = min(max((next_attempt_at - datetime.utcnow()).total_seconds(), 1), idle_delay)
+                    await asyncio.sleep(delay)
             except Exception as e:
                 logger.error(e)
                 await asyncio.sleep(100)
 
 
+async def enforce_retention(interval=86400):
+    # TRIP_RETENTION_MONTHS / TRIP_RETENTION_ACTION, see sql.RetentionPolicy
+    while True:
+        try:
+            removed = await run_blocking(sql.apply_retention_policy, sql.DatabaseMixin.create_engine())
+            if removed:
+                logger.info(f'Retention -- {sql.retention_policy.action} partitions: {removed}')
+        except Exception as e:
+            logger.error(e)
+        await asyncio.sleep(interval)
+
+
+async def report_metrics(loop_monitor: LoopLagMonitor, interval=300):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(f'Database pool -- {sql.pool_metrics.snapshot()}')
+        logger.info(f'Event loop -- {loop_monitor.snapshot()}')
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the BlueBike prediction pipeline.')
+    parser.add_argument('--requeue-dead-actuals', nargs='*', metavar='BATCH_ID',
+                        help='retry dead-lettered actuals batches, all of them unless batch ids are given, and exit')
+    args = parser.parse_args()
+
     # initialization
     sql.create_database()
     sql.create_tables()
@@ -60,8 +106,24 @@ if __name__ == '__main__':
     logging.basicConfig()
     logging.getLogger().setLevel(logging.DEBUG)
 
+    if args.requeue_dead_actuals is not None:
+        logger.info(f'Actuals - requeued {Actuals.requeue_dead(args.requeue_dead_actuals)} dead batches.')
+        logger.info(f'Actuals - outbox batches: {Actuals.outbox_status()}')
+        raise SystemExit
+
     # start run loop
     loop = asyncio.get_event_loop()
-    loop.create_task(import_data())
-    loop.run_forever()
-    loop.close()
+    loop.create_task(import_data(workers=int(os.getenv('IMPORT_WORKERS', 0))))
+    loop_monitor = LoopLagMonitor(threshold=float(os.getenv('LOOP_LAG_THRESHOLD', 0.1)))
+    loop.create_task(loop_monitor.run())
+    loop.create_task(report_metrics(loop_monitor))
+    loop.create_task(enforce_retention())
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # connections are returned and closed instead of dropped with the process
+        loop.run_until_complete(sql.close_engines())
+        loop.close()
@@ -1,4 +1,10 @@
 from .actuals import Actuals
+from .backends import ScoringBackend, DataRobotBackend, LocalMedianBackend
 from .data_importer import StationDataImporter, TripDataImporter
-from .scoring import Scoring
+from .monitor import LoopLagMonitor
+from .parallel_importer import ParallelTripImporter
+from .prediction_cache import CachedBackend
+from .scheduler import AdaptiveScheduler
+from .scoring import Scoring, ScoringFailed
+from .station_registry import StationRecord, StationRegistry, station_registry
 from .training import TrainingData
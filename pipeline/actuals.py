@@ -1,37 +1,130 @@
+import asyncio
 import logging
 import os
+import random
+import uuid
+from datetime import datetime, timedelta
 
 import aiohttp
 
 from database import Database
+from .base import run_blocking
 
 logger = logging.getLogger(__name__)
 
 
 class Actuals:
-    def __init__(self, session: aiohttp.ClientSession):
+    # actuals go through the `actuals_outbox` table: trips are moved into a batch once, and a batch
+    # is replayed until DataRobot accepts it or it runs out of attempts. a replay sends the same
+    # association ids again, which DataRobot overwrites, so any number of submitters can run
+    def __init__(self, session: aiohttp.ClientSession, batch_size: int = 1000, max_in_flight: int = 4,
+                 max_attempts: int = 8, retry_delay: float = 30.0, lease: int = 300):
         self.session = session
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease = lease
 
-    async def upload(self):
+    async def upload(self) -> int:
+        # sends due retries first, then enqueues new batches, keeping up to `max_in_flight` requests
+        # in flight; returns the number of actuals submitted, 0 once nothing is due
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        batches = []
+
+        while True:
+            await semaphore.acquire()
+            batch = await run_blocking(self.claim_batch, self.lease)
+            if batch is None:
+                batch = await run_blocking(self.enqueue_batch, self.batch_size, self.lease)
+            if batch is None:
+                semaphore.release()
+                break
+
+            batch_id, trip_ids, attempt = batch
+            logger.info(f'Actuals - batch {batch_id}: {len(trip_ids)} actual values, attempt {attempt}.')
+            batches.append(asyncio.ensure_future(self._upload_batch(batch_id, trip_ids, attempt, semaphore)))
+
+        results = await asyncio.gather(*batches, return_exceptions=True)
+        submitted_count = 0
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f'Error submitting actuals: {result}')
+            else:
+                submitted_count += result
+        return submitted_count
+
+    async def _upload_batch(self, batch_id: str, trip_ids: [int], attempt: int,
+                            semaphore: asyncio.Semaphore) -> int:
+        try:
+            actuals = await run_blocking(self.select_actuals, trip_ids)
+            try:
+                await self._make_request(actuals)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                await run_blocking(self.record_failure, batch_id, attempt, repr(e))
+                return 0
+
+            # if this fails the lease runs out and the batch is replayed, never accounted twice
+            if not await run_blocking(self.mark_sent, batch_id):
+                return 0
+            return len(actuals)
+        finally:
+            semaphore.release()
+
+    def record_failure(self, batch_id: str, attempt: int, error: str):
+        if attempt >= self.max_attempts:
+            logger.error(f'Actuals - batch {batch_id} dead-lettered after {attempt} attempts: {error}')
+            retry_at = None
+        else:
+            delay = self.retry_delay * 2 ** (attempt - 1)
+            delay = random.uniform(delay / 2, delay)
+            logger.warning(f'Actuals - batch {batch_id} failed ({error}), retrying in {delay:.1f}s.')
+            retry_at = datetime.utcnow() + timedelta(seconds=delay)
+        with Database() as database:
+            database.mark_actuals_failed(batch_id, error, retry_at)
+
+    @staticmethod
+    def enqueue_batch(limit: int = 1000, lease: int = 300) -> (str, [int], int):
+        batch_id = uuid.uuid4().hex
         with Database() as database:
-            trips = database.get_actuals()
-            trip_ids = [trip.id for trip in trips]
-            actuals = [{
+            trip_ids = database.enqueue_actuals(batch_id, limit=limit, lease=lease)
+        if not trip_ids:
+            return None
+        return batch_id, trip_ids, 1
+
+    @staticmethod
+    def claim_batch(lease: int = 300) -> (str, [int], int):
+        with Database() as database:
+            return database.claim_actuals_batch(lease=lease)
+
+    @staticmethod
+    def select_actuals(trip_ids: [int]) -> [dict]:
+        with Database() as database:
+            trips = database.get_actuals(trip_ids)
+            return [{
                 'associationId': trip.id,
                 'actualValue': trip.trip_duration
             } for trip in trips]
 
-        if not actuals:
-            return
-
-        logger.info(f'Actuals - gathering {len(actuals)} actual values to submit.')
-        logger.debug(f'Actuals - trip_ids: {trip_ids}')
+    @staticmethod
+    def mark_sent(batch_id: str) -> bool:
+        with Database() as database:
+            return database.mark_actuals_sent(batch_id)
 
-        await self._make_request(actuals)
+    @staticmethod
+    def next_attempt_at() -> datetime:
+        with Database() as database:
+            return database.next_actuals_attempt()
 
+    @staticmethod
+    def requeue_dead(batch_ids: [str] = None) -> int:
         with Database() as database:
-            database.mark_actuals_submitted(trip_ids)
+            return database.requeue_dead_actuals(batch_ids)
 
+    @staticmethod
+    def outbox_status() -> dict:
+        with Database() as database:
+            return database.count_actuals_batches()
 
     async def _make_request(self, payload: list):
         api_endpoint = os.getenv('DATAROBOT_ENDPOINT')
@@ -42,7 +135,8 @@ class Actuals:
         url = f'{api_endpoint}/deployments/{deployment_id}/actuals/fromJSON/'
 
         async with self.session.post(url, headers=headers, json={'data': payload}) as resp:
-            if resp.status >= 200 and resp.status < 300:
-                logger.info(f'Actuals - submitted {len(payload)} actual values.')
-            else:
-                logger.error(f'Error submitting actuals: {resp}')
+            if resp.status < 200 or resp.status >= 300:
+                raise aiohttp.ClientResponseError(
+                    resp.request_info, resp.history, status=resp.status, message=await resp.text()
+                )
+            logger.info(f'Actuals - submitted {len(payload)} actual values.')
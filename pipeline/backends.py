@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import os
+import random
+
+import aiohttp
+import numpy as np
+import pandas as pd
+from aiohttp import BasicAuth
+
+import sql
+from database import Database
+from .base import ScoringBackend
+from .prediction_cache import CachedBackend
+
+logger = logging.getLogger(__name__)
+
+
+class DataRobotBackend(ScoringBackend):
+    def __init__(self, session: aiohttp.ClientSession, max_attempts: int = 5, retry_delay: float = 1.0):
+        self.session = session
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+    async def predict(self, payload: [dict]) -> [float]:
+        response = await self._request_with_retries(payload)
+
+        # the deployment may answer out of order, rows are matched by their position in the request
+        response_data = sorted(response.get('data', []), key=lambda row: row.get('rowId', 0))
+        return [prediction['prediction'] for prediction in response_data]
+
+    async def _request_with_retries(self, payload: [dict]) -> dict:
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return await self._make_prediction_request(payload)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # a rejected payload fails the same way every time, only transient errors are retried
+                retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status >= 500 or e.status == 429
+                if not retryable or attempt == self.max_attempts:
+                    raise
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                logger.warning(f'Prediction request failed ({e}), attempt {attempt}, retrying in {delay:.1f}s.')
+                await asyncio.sleep(random.uniform(delay / 2, delay))
+
+    async def _make_prediction_request(self, payload: list):
+        username = os.getenv('DATAROBOT_USERNAME')
+        api_endpoint = os.getenv('DATAROBOT_PRED_ENDPOINT')
+        api_token = os.getenv('DATAROBOT_API_TOKEN')
+        deployment_id = os.getenv('DEPLOYMENT_ID')
+        datarobot_key = os.getenv('DATAROBOT_KEY')
+
+        headers = {'datarobot-key': datarobot_key}
+        url = f'{api_endpoint}/deployments/{deployment_id}/predictions'
+
+        auth = BasicAuth(username, api_token)
+        async with self.session.post(url, auth=auth, headers=headers, json=payload) as resp:
+            if resp.status != 200:
+                raise aiohttp.ClientResponseError(
+                    resp.request_info, resp.history, status=resp.status, message=await resp.text()
+                )
+            return await resp.json()
+
+
+class LocalMedianBackend(ScoringBackend):
+    # median trip duration per start station and hour of day, falling back to the station median,
+    # then the hour median, then the overall median; lookups are binary searches over whole arrays
+    uses_features = True
+
+    def __init__(self, station_hour_keys: np.ndarray, station_hour_medians: np.ndarray,
+                 station_keys: np.ndarray, station_medians: np.ndarray,
+                 hour_medians: np.ndarray, global_median: float):
+        self.station_hour_keys = station_hour_keys
+        self.station_hour_medians = station_hour_medians
+        self.station_keys = station_keys
+        self.station_medians = station_medians
+        self.hour_medians = hour_medians
+        self.global_median = float(global_median)
+
+    @classmethod
+    def fit(cls, station_ids, start_times, trip_durations) -> 'LocalMedianBackend':
+        data_frame = pd.DataFrame({
+            'station_id': pd.to_numeric(pd.Series(station_ids), errors='coerce').to_numpy(),
+            'hour': pd.to_datetime(pd.Series(start_times)).dt.hour.to_numpy(),
+            'trip_duration': pd.Series(trip_durations).to_numpy(dtype=float),
+        }).dropna()
+        if data_frame.empty:
+            raise ValueError('No trips to fit a local model to.')
+        data_frame['station_id'] = data_frame['station_id'].astype(np.int64)
+        data_frame['key'] = data_frame['station_id'] * 24 + data_frame['hour']
+
+        by_station_hour = data_frame.groupby('key')['trip_duration'].median().sort_index()
+        by_station = data_frame.groupby('station_id')['trip_duration'].median().sort_index()
+        global_median = data_frame['trip_duration'].median()
+        by_hour = data_frame.groupby('hour')['trip_duration'].median().reindex(range(24)).fillna(global_median)
+        return cls(
+            station_hour_keys=by_station_hour.index.to_numpy(dtype=np.int64),
+            station_hour_medians=by_station_hour.to_numpy(dtype=float),
+            station_keys=by_station.index.to_numpy(dtype=np.int64),
+            station_medians=by_station.to_numpy(dtype=float),
+            hour_medians=by_hour.to_numpy(dtype=float),
+            global_median=global_median,
+        )
+
+    @classmethod
+    def from_training_data(cls, path='training.csv') -> 'LocalMedianBackend':
+        data_frame = pd.read_csv(path, usecols=['start_station_id', 'start_time', 'trip_duration'])
+        return cls.fit(data_frame['start_station_id'], data_frame['start_time'], data_frame['trip_duration'])
+
+    @classmethod
+    def from_aggregates(cls, rows: [tuple]) -> 'LocalMedianBackend':
+        # medians of the summed trip_aggregates histograms (Database.get_trip_aggregates), which
+        # costs one row per station, hour of day and user type instead of one per trip
+        keys = pd.DataFrame({
+            'station_id': pd.to_numeric(pd.Series([row.start_station_id for row in rows], dtype=object),
+                                        errors='coerce'),
+            'hour': [row.hour for row in rows],
+        })
+        histograms = pd.DataFrame(
+            np.array([row.histogram for row in rows], dtype=np.int64).reshape(len(rows), sql.HISTOGRAM_BINS)
+        )
+        # rows without trips (only prediction errors) have no median and must not shadow the fallbacks
+        valid = keys['station_id'].notna().to_numpy() & (histograms.to_numpy().sum(axis=1) > 0)
+        if not valid.any():
+            # a model of nothing but NaN medians would score every trip NaN until it is deleted
+            raise ValueError('No trip aggregates to build a local model from.')
+        keys, histograms = keys[valid].astype(np.int64), histograms[valid]
+        keys['key'] = keys['station_id'] * 24 + keys['hour']
+
+        by_station_hour = histograms.groupby(keys['key']).sum().sort_index()
+        by_station = histograms.groupby(keys['station_id']).sum().sort_index()
+        by_hour = histograms.groupby(keys['hour']).sum().reindex(range(24), fill_value=0)
+        global_median = cls._histogram_medians(histograms.sum().to_numpy()[np.newaxis])[0]
+        hour_medians = cls._histogram_medians(by_hour.to_numpy())
+        return cls(
+            station_hour_keys=by_station_hour.index.to_numpy(dtype=np.int64),
+            station_hour_medians=cls._histogram_medians(by_station_hour.to_numpy()),
+            station_keys=by_station.index.to_numpy(dtype=np.int64),
+            station_medians=cls._histogram_medians(by_station.to_numpy()),
+            hour_medians=np.where(np.isnan(hour_medians), global_median, hour_medians),
+            global_median=global_median,
+        )
+
+    @staticmethod
+    def _histogram_medians(histograms: np.ndarray) -> np.ndarray:
+        # row wise sql.histogram_percentile(histogram, 0.5), NaN for empty histograms
+        totals = histograms.sum(axis=1)
+        cumulative = histograms.cumsum(axis=1)
+        rows = np.arange(len(histograms))
+        bins = np.argmax(cumulative >= (totals / 2)[:, np.newaxis], axis=1)
+        counts = histograms[rows, bins]
+        before = cumulative[rows, bins] - counts
+        with np.errstate(divide='ignore', invalid='ignore'):
+            position = bins + (totals / 2 - before) / counts
+        return np.where(totals > 0, 2 ** (position / sql.BINS_PER_DOUBLING), np.nan)
+
+    @classmethod
+    def load(cls, path) -> 'LocalMedianBackend':
+        with np.load(path) as data:
+            return cls(**{key: data[key] for key in data.files})
+
+    def save(self, path):
+        np.savez(
+            path,
+            station_hour_keys=self.station_hour_keys,
+            station_hour_medians=self.station_hour_medians,
+            station_keys=self.station_keys,
+            station_medians=self.station_medians,
+            hour_medians=self.hour_medians,
+            global_median=self.global_median,
+        )
+
+    async def predict(self, payload: [dict]) -> [float]:
+        # the `hour` feature Scoring computed for the batch, start_time is only parsed without it
+        station_ids = [item['start_station_id'] for item in payload]
+        if payload and 'hour' in payload[0]:
+            return self.predict_arrays(station_ids, hours=[item['hour'] for item in payload]).tolist()
+        return self.predict_arrays(station_ids, [item['start_time'] for item in payload]).tolist()
+
+    def predict_arrays(self, station_ids, start_times=None, hours=None) -> np.ndarray:
+        station_ids = pd.to_numeric(pd.Series(station_ids), errors='coerce').fillna(-1).to_numpy(dtype=np.int64)
+        if hours is None:
+            hours = pd.to_datetime(pd.Series(start_times)).dt.hour
+        hours = np.asarray(hours, dtype=np.int64)
+
+        predictions = self.hour_medians[hours]
+        station_values, station_found = self._lookup(self.station_keys, self.station_medians, station_ids)
+        predictions = np.where(station_found, station_values, predictions)
+        station_hour_values, station_hour_found = self._lookup(
+            self.station_hour_keys, self.station_hour_medians, station_ids * 24 + hours
+        )
+        return np.where(station_hour_found, station_hour_values, predictions)
+
+    @staticmethod
+    def _lookup(keys: np.ndarray, values: np.ndarray, targets: np.ndarray) -> (np.ndarray, np.ndarray):
+        if len(keys) == 0:
+            return np.zeros(len(targets)), np.zeros(len(targets), dtype=bool)
+        positions = np.minimum(np.searchsorted(keys, targets), len(keys) - 1)
+        return values[positions], keys[positions] == targets
+
+
+def create_backend(session: aiohttp.ClientSession, name: str = None) -> ScoringBackend:
+    # SCORING_BACKEND selects the backend of a deployment: `datarobot` (default) or `local`;
+    # PREDICTION_CACHE_SIZE > 0 puts a prediction cache in front of it, which changes the rows a
+    # deployment receives, so it is off by default
+    name = name or os.getenv('SCORING_BACKEND', 'datarobot')
+    if name == 'local':
+        model_path = os.getenv('LOCAL_MODEL_PATH', 'local_model.npz')
+        training_data_path = os.getenv('TRAINING_DATA_PATH', 'training.csv')
+        # the saved model is rebuilt once the training data is newer than it; a model built from the
+        # trip aggregates is rebuilt by deleting LOCAL_MODEL_PATH
+        if os.path.exists(model_path) and not _is_older(model_path, training_data_path):
+            backend = LocalMedianBackend.load(model_path)
+        else:
+            if os.path.exists(training_data_path):
+                backend = LocalMedianBackend.from_training_data(training_data_path)
+            else:
+                with Database() as database:
+                    backend = LocalMedianBackend.from_aggregates(database.get_trip_aggregates())
+            backend.save(model_path)
+    elif name == 'datarobot':
+        backend = DataRobotBackend(session)
+    else:
+        raise ValueError(f'Unknown scoring backend: {name}')
+
+    cache_size = int(os.getenv('PREDICTION_CACHE_SIZE', 0))
+    if cache_size <= 0:
+        return backend
+    return CachedBackend(
+        backend,
+        max_size=cache_size,
+        ttl=float(os.getenv('PREDICTION_CACHE_TTL', 3600)),
+        bucket_minutes=int(os.getenv('PREDICTION_CACHE_BUCKET_MINUTES', 60)),
+    )
+
+
+def _is_older(path, source_path) -> bool:
+    return os.path.exists(source_path) and os.path.getmtime(path) < os.path.getmtime(source_path)
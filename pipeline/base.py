@@ -1,7 +1,22 @@
+import abc
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from aiohttp import ClientSession
 import typing
 
+# synchronous database and pandas work runs here instead of on the event loop
+blocking_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('BLOCKING_EXECUTOR_WORKERS', 4)),
+    thread_name_prefix='blocking',
+)
+
+
+async def run_blocking(func: typing.Callable, *args):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(blocking_executor, func, *args)
+
 
 class HTTPSessionMixin:
     def __init__(self, *args, **kwargs):
@@ -11,3 +26,13 @@ class HTTPSessionMixin:
     async def create_session(self) -> typing.AsyncContextManager[ClientSession]:
         async with ClientSession() as session:
             yield session
+
+
+class ScoringBackend(abc.ABC):
+    # scores a batch of prediction payloads, returning one predicted trip duration per payload;
+    # the payloads carry the FEATURE_COLUMNS only for backends that use them
+    uses_features = False
+
+    @abc.abstractmethod
+    async def predict(self, payload: [dict]) -> [float]:
+        pass
@@ -0,0 +1,132 @@
+import json
+import os
+import typing
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+MANIFEST_FILE_NAME = '_manifest.json'
+
+# strings with few distinct values (station names, user types), stored once per row group
+DICTIONARY_STRING = pa.dictionary(pa.int32(), pa.string())
+
+
+def partition_path(directory, year: int, month: int, file_name: str = 'part.parquet') -> Path:
+    # hive style partition directories, read back as year/month columns by pyarrow and pandas
+    return Path(directory, f'year={year:04d}', f'month={month:02d}', file_name)
+
+
+def record_batch(rows: typing.Sequence[tuple], schema: pa.Schema) -> pa.RecordBatch:
+    # row tuples to typed arrow columns, string columns with a dictionary type are encoded once
+    # per batch so repeated station names and user types are stored as small integer indices
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+    arrays = []
+    for field, values in zip(schema, columns):
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(values, type=field.type.value_type).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def encode_strings(table: pa.Table) -> pa.Table:
+    # dictionary encodes every string column of a table built from pandas; categoricals keep their
+    # encoding but get int32 indices, pandas picks the smallest code type for every chunk
+    for index, field in enumerate(table.schema):
+        column = table.column(index)
+        if pa.types.is_dictionary(field.type):
+            if field.type.index_type == pa.int32():
+                continue
+            column = column.cast(field.type.value_type)
+        elif not (pa.types.is_string(field.type) or pa.types.is_large_string(field.type)):
+            continue
+        table = table.set_column(index, field.name, column.dictionary_encode())
+    return table
+
+
+class PartitionWriter:
+    # writes one parquet file to a temporary path, replaced atomically on close so a failed or
+    # interrupted export never leaves a half written partition behind
+    def __init__(self, path: Path, schema: pa.Schema = None):
+        self.path = Path(path)
+        self.schema = schema
+        self.row_count = 0
+        self._temp_path = self.path.with_name(f'.{self.path.name}.tmp')
+        self._writer: pq.ParquetWriter = None
+
+    def write(self, data: typing.Union[pa.RecordBatch, pa.Table]):
+        if isinstance(data, pa.RecordBatch):
+            data = pa.Table.from_batches([data])
+        if self._writer is None:
+            self.schema = self.schema or data.schema
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._writer = pq.ParquetWriter(str(self._temp_path), self.schema, compression='snappy')
+        self._writer.write_table(data)
+        self.row_count += data.num_rows
+
+    def close(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._writer = None
+        os.replace(self._temp_path, self.path)
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._temp_path.exists():
+            self._temp_path.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class PartitionManifest:
+    # fingerprint of the source data every partition (or source file) was last written from,
+    # re-exports skip the entries whose fingerprint did not change
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.path = self.directory / MANIFEST_FILE_NAME
+        self.entries: typing.Dict[str, dict] = {}
+        if self.path.exists():
+            self.entries = json.loads(self.path.read_text())
+
+    def is_current(self, key: str, fingerprint: str) -> bool:
+        entry = self.entries.get(key)
+        return entry is not None and entry['fingerprint'] == fingerprint and all(
+            (self.directory / file_name).exists() for file_name in entry['files']
+        )
+
+    def update(self, key: str, fingerprint: str, paths: typing.Iterable[Path]):
+        self.entries[key] = {
+            'fingerprint': fingerprint,
+            'files': sorted(str(Path(path).relative_to(self.directory)) for path in paths),
+        }
+        self.save()
+
+    def remove(self, key: str):
+        # deletes the files written for `key`, and the partition directories left empty
+        entry = self.entries.pop(key, None)
+        for file_name in entry['files'] if entry else []:
+            path = self.directory / file_name
+            if path.exists():
+                path.unlink()
+            for parent in path.parents:
+                if parent == self.directory or not parent.exists() or any(parent.iterdir()):
+                    break
+                parent.rmdir()
+        self.save()
+
+    def save(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_name(f'.{self.path.name}.tmp')
+        temp_path.write_text(json.dumps(self.entries, indent=2, sort_keys=True))
+        os.replace(temp_path, self.path)
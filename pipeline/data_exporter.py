@@ -1,91 +1,228 @@
+import csv
+import hashlib
 import logging
+import time
 from datetime import datetime
 from pathlib import Path
 
 import pandas as pd
+import pyarrow as pa
 import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
 
 import sql
 from sql import DatabaseMixin
+from .columnar import DICTIONARY_STRING, PartitionManifest, PartitionWriter, partition_path, record_batch
 
 logger = logging.getLogger(__name__)
 
+# same order as DataExporter._trip_export_columns
+TRIP_EXPORT_SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('trip_duration', pa.float64()),
+    ('start_station_id', DICTIONARY_STRING),
+    ('start_station_name', DICTIONARY_STRING),
+    ('start_station_latitude', pa.float64()),
+    ('start_station_longitude', pa.float64()),
+    ('start_station_region_name', DICTIONARY_STRING),
+    ('start_station_capacity', pa.int32()),
+    ('start_station_has_kiosk', pa.bool_()),
+    ('start_time', pa.timestamp('us')),
+    ('bike_id', pa.int32()),
+    ('user_type', DICTIONARY_STRING),
+    ('user_birth_year', pa.int16()),
+    ('user_gender', DICTIONARY_STRING),
+])
+
+STATION_EXPORT_SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('name', pa.string()),
+    ('latitude', pa.float64()),
+    ('longitude', pa.float64()),
+    ('region_id', DICTIONARY_STRING),
+    ('region_name', DICTIONARY_STRING),
+    ('capacity', pa.int32()),
+    ('has_kiosk', pa.bool_()),
+])
+
 
 class DataExporter(DatabaseMixin):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._engine = self.create_engine()
 
-    def export_trip_data(self, batch_size=10000, csv_path='../data/bluebike_trips_2019.csv'):
-        start, end = datetime(2019, 1, 1), datetime(2020, 1, 1)
-        conn = self._engine.connect()
-
-        # delete existing file
+    def export_trip_data(self, batch_size=10000, csv_path='../data/bluebike_trips_2019.csv',
+                         start=datetime(2019, 1, 1), end=datetime(2020, 1, 1), use_copy=False,
+                         output_format='csv'):
+        # parquet exports go to a directory named after `csv_path`, partitioned by year and month
         path = Path(csv_path)
-        if path.exists():
-            path.unlink()
-
-        # get total count of rows
-        statement = sa.select([
-            sa.func.count(sql.trips.c.id).label('count')
+        started_at = time.perf_counter()
+        if output_format == 'parquet':
+            exported_count = self._export_trip_partitions(path.with_suffix(''), start, end, batch_size)
+        else:
+            # delete existing file
+            if path.exists():
+                path.unlink()
+
+            if use_copy:
+                exported_count = self._copy_trip_data(path, start, end)
+            else:
+                exported_count = self._stream_trip_data(path, start, end, batch_size)
+
+        elapsed = time.perf_counter() - started_at
+        logger.info(
+            f'Exported {exported_count} rows in {elapsed:.2f}s '
+            f'({exported_count / elapsed if elapsed else 0:.0f} rows/s).'
+        )
+
+    def _stream_trip_data(self, path: Path, start: datetime, end: datetime, batch_size: int) -> int:
+        exported_count = 0
+        with self._engine.connect() as conn, open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(column.name for column in self._trip_export_columns())
+
+            for rows in self._trip_pages(conn, start, end, batch_size):
+                # append to csv file
+                writer.writerows(rows)
+
+                # logging
+                exported_count += len(rows)
+                logger.info(f'Exported {exported_count} rows, up to {rows[-1].start_time}.')
+        return exported_count
+
+    def _trip_pages(self, conn, start: datetime, end: datetime, batch_size: int):
+        # keyset pagination on (start_time, id): every page is an index range scan starting where
+        # the previous page stopped, instead of an offset that rescans all the rows before it
+        last_key = None
+        while True:
+            statement = self._trip_export_statement(start, end)
+            if last_key is not None:
+                statement = statement.where(
+                    sa.tuple_(sql.trips.c.start_time, sql.trips.c.id) > sa.tuple_(*last_key)
+                )
+            rows = conn.execute(statement.limit(batch_size)).fetchall()
+            if not rows:
+                return
+            yield rows
+            last_key = (rows[-1].start_time, rows[-1].id)
+
+    def _export_trip_partitions(self, directory: Path, start: datetime, end: datetime, batch_size: int) -> int:
+        # a month is only rewritten when its trips, or the stations joined into them, changed since
+        # the last export; months that no longer have trips are removed
+        manifest = PartitionManifest(directory)
+        exported_count = 0
+        with self._engine.connect() as conn:
+            station_fingerprint = self._station_fingerprint(conn)
+            fingerprints = {
+                (int(row.year), int(row.month)):
+                    f'{row.count}:{row.id_sum}:{row.last_start_time}:{station_fingerprint}'
+                for row in conn.execute(self._month_fingerprint_statement(start, end))
+            }
+
+            for key in list(manifest.entries):
+                year, month = map(int, key.split('-'))
+                if start <= datetime(year, month, 1) < end and (year, month) not in fingerprints:
+                    manifest.remove(key)
+                    logger.info(f'Removed partition {key}, it has no trips left.')
+
+            for (year, month), fingerprint in sorted(fingerprints.items()):
+                key = f'{year:04d}-{month:02d}'
+                if manifest.is_current(key, fingerprint):
+                    logger.info(f'Partition {key} is up to date.')
+                    continue
+
+                month_start = datetime(year, month, 1)
+                month_end = datetime(year + month // 12, month % 12 + 1, 1)
+                path = partition_path(directory, year, month)
+                with PartitionWriter(path, TRIP_EXPORT_SCHEMA) as writer:
+                    for rows in self._trip_pages(conn, max(start, month_start), min(end, month_end), batch_size):
+                        writer.write(record_batch(rows, TRIP_EXPORT_SCHEMA))
+                manifest.update(key, fingerprint, [path])
+
+                exported_count += writer.row_count
+                logger.info(f'Exported {writer.row_count} rows to partition {key}.')
+        return exported_count
+
+    @staticmethod
+    def _month_fingerprint_statement(start: datetime, end: datetime) -> sa.sql.Select:
+        # cheap per month summary, any inserted or deleted trip changes the count or the id sum
+        year = sa.extract('year', sql.trips.c.start_time)
+        month = sa.extract('month', sql.trips.c.start_time)
+        return sa.select([
+            year.label('year'),
+            month.label('month'),
+            sa.func.count(sql.trips.c.id).label('count'),
+            sa.func.sum(sql.trips.c.id).label('id_sum'),
+            sa.func.max(sql.trips.c.start_time).label('last_start_time'),
         ]).where(sa.and_(
             sql.trips.c.start_time >= start,
             sql.trips.c.start_time < end,
-        ))
-        total_count = conn.execute(statement).fetchone()['count']
-
-        # export to csv
-        for skip in range(0, total_count, batch_size):
-            statement = sa.select([
-                sql.trips.c.id,
-                sql.trips.c.trip_duration,
-                sql.trips.c.start_station_id,
-                sql.stations.c.name.label('start_station_name'),
-                sql.stations.c.latitude.label('start_station_latitude'),
-                sql.stations.c.longitude.label('start_station_longitude'),
-                sql.stations.c.region_name.label('start_station_region_name'),
-                sql.stations.c.capacity.label('start_station_capacity'),
-                sql.stations.c.has_kiosk.label('start_station_has_kiosk'),
-                sql.trips.c.start_time,
-                sql.trips.c.bike_id,
-                sql.trips.c.user_type,
-                sql.trips.c.user_birth_year,
-                sql.trips.c.user_gender,
-            ]).select_from(
-                sql.trips.join(sql.stations, sql.trips.c.start_station_id == sql.stations.c.id),
-            ).where(sa.and_(
-                sql.trips.c.start_time >= start,
-                sql.trips.c.start_time < end,
-            )).order_by(sql.trips.c.start_time).limit(batch_size).offset(skip)
-            rows = conn.execute(statement).fetchall()
-
-            # append to csv file
-            rows = [dict(row) for row in rows]
-            data_frame = pd.DataFrame(rows)
-            data_frame.to_csv(csv_path, mode='a', index=False, header=skip == 0)
-
-            # logging
-            exported_count = skip + len(rows)
-            logger.info(
-                f'Exported {exported_count} / {total_count} rows, '
-                f'progress: {exported_count/total_count:.2%}'
-            )
-
-    def export_station_data(self, csv_path='../data/bluebike_stations.csv'):
-        # delete existing file
-        path = Path(csv_path)
-        if path.exists():
-            path.unlink()
+        )).group_by(year, month)
+
+    @staticmethod
+    def _station_fingerprint(conn) -> str:
+        rows = conn.execute(sa.select([sql.stations]).order_by(sql.stations.c.id)).fetchall()
+        return hashlib.sha1(repr([tuple(row) for row in rows]).encode()).hexdigest()[:16]
+
+    def _copy_trip_data(self, path: Path, start: datetime, end: datetime) -> int:
+        # a single COPY streams the whole result set from the server, values are formatted by
+        # postgres (booleans as t/f) rather than by python
+        statement = self._trip_export_statement(start, end).compile(dialect=postgresql.psycopg2.dialect())
+        connection = self._engine.raw_connection()
+        try:
+            with connection.cursor() as cursor, open(path, 'w', newline='') as file:
+                # a full year takes as long as it takes
+                sql.without_statement_timeout(cursor)
+                query = cursor.mogrify(str(statement), statement.params).decode()
+                cursor.copy_expert(f'COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)', file)
+                exported_count = cursor.rowcount
+            connection.commit()
+        finally:
+            connection.close()
+        return exported_count
+
+    @staticmethod
+    def _trip_export_columns() -> list:
+        return [
+            sql.trips.c.id,
+            sql.trips.c.trip_duration,
+            sql.trips.c.start_station_id,
+            sql.stations.c.name.label('start_station_name'),
+            sql.stations.c.latitude.label('start_station_latitude'),
+            sql.stations.c.longitude.label('start_station_longitude'),
+            sql.stations.c.region_name.label('start_station_region_name'),
+            sql.stations.c.capacity.label('start_station_capacity'),
+            sql.stations.c.has_kiosk.label('start_station_has_kiosk'),
+            sql.trips.c.start_time,
+            sql.trips.c.bike_id,
+            sql.trips.c.user_type,
+            sql.trips.c.user_birth_year,
+            sql.trips.c.user_gender,
+        ]
+
+    @classmethod
+    def _trip_export_statement(cls, start: datetime, end: datetime) -> sa.sql.Select:
+        return sa.select(cls._trip_export_columns()).select_from(
+            sql.trips.join(sql.stations, sql.trips.c.start_station_id == sql.stations.c.id),
+        ).where(sa.and_(
+            sql.trips.c.start_time >= start,
+            sql.trips.c.start_time < end,
+        )).order_by(sql.trips.c.start_time, sql.trips.c.id)
 
+    def export_station_data(self, csv_path='../data/bluebike_stations.csv', output_format='csv'):
         # read data
         conn = self._engine.connect()
         statement = sa.select([sql.stations])
         rows = conn.execute(statement).fetchall()
 
         # write data
-        rows = [dict(row) for row in rows]
-        data_frame = pd.DataFrame(rows)
-        data_frame.to_csv(csv_path, index=False)
+        if output_format == 'parquet':
+            with PartitionWriter(Path(csv_path).with_suffix('.parquet'), STATION_EXPORT_SCHEMA) as writer:
+                writer.write(record_batch(rows, STATION_EXPORT_SCHEMA))
+        else:
+            rows = [dict(row) for row in rows]
+            data_frame = pd.DataFrame(rows)
+            data_frame.to_csv(csv_path, index=False)
 
         # logging
         logger.info(f'Exported {len(rows)} stations.')
@@ -97,4 +234,4 @@ if __name__ == '__main__':
 
     exporter = DataExporter()
     exporter.export_station_data()
-    exporter.export_trip_data()
+    exporter.export_trip_data(use_copy=True)
@@ -1,16 +1,27 @@
+import asyncio
 import dataclasses
+import hashlib
+import io
 import logging
+import time
+import typing
+import zipfile
+from datetime import datetime
 from pathlib import Path
-from uuid import uuid4
 
 import pandas
 import sqlalchemy as sa
 from aiohttp import ClientSession
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import insert
 
 import sql
+from data_sources import read_csv_chunks, trip_ids
 from entities import Region, Station
 from sql import DatabaseMixin
-from .base import HTTPSessionMixin
+from .base import HTTPSessionMixin, run_blocking
+from .gbfs import feed_cache
+from .station_registry import station_registry
 
 logger = logging.getLogger(__name__)
 
@@ -23,12 +34,19 @@ class StationDataImporter(DatabaseMixin, HTTPSessionMixin):
         async with self.create_session() as session:
             stations = await self._fetch_stations(session)
         await self._upsert_stations(stations)
+        await self.refresh_registry()
+
+    async def refresh_registry(self):
+        # the whole table, trip-only stations included, is read once per gbfs refresh instead of
+        # once per batch by everything that needs station attributes
+        async with self.conn() as conn:
+            result = await conn.execute(sa.select([sql.stations]))
+            station_registry.replace(await result.fetchall())
 
     @staticmethod
     async def _fetch_regions(session: ClientSession) -> {str, Region}:
         url = 'https://gbfs.bluebikes.com/gbfs/en/system_regions.json'
-        async with session.get(url) as response:
-            response_data = await response.json()
+        response_data = await feed_cache.fetch(session, url)
 
         regions = {}
         for item in response_data.get('data', {}).get('regions', []):
@@ -44,10 +62,11 @@ class StationDataImporter(DatabaseMixin, HTTPSessionMixin):
 
     async def _fetch_stations(self, session: ClientSession) -> {str, Station}:
         url = 'https://gbfs.bluebikes.com/gbfs/en/station_information.json'
-        async with session.get(url) as response:
-            response_data = await response.json()
+        response_data, regions = await asyncio.gather(
+            feed_cache.fetch(session, url),
+            self._fetch_regions(session),
+        )
 
-        regions = await self._fetch_regions(session)
         stations = {}
         for item in response_data.get('data', {}).get('stations', []):
             try:
@@ -57,6 +76,7 @@ class StationDataImporter(DatabaseMixin, HTTPSessionMixin):
                     'name': item['name'],
                     'latitude': item['lat'],
                     'longitude': item['lon'],
+                    'region_id': str(region.id),
                     'region_name': region.name,
                     'capacity': item['capacity'],
                     'has_kiosk': item['has_kiosk'],
@@ -66,32 +86,57 @@ class StationDataImporter(DatabaseMixin, HTTPSessionMixin):
                 continue
         return stations
 
-    async def _upsert_stations(self, stations: {str, Station}):
-        # retrieve ids for all existing stations
-        async with self.conn() as conn:
-            result = await conn.execute(sa.select([sql.stations.c.id]))
-            existing_station_ids = [row.id async for row in result]
-
-        # figure out which stations should be inserted
-        new_station_ids = set(stations.keys()) - set(existing_station_ids)
-        new_stations = {
-            station_id: station for station_id, station in stations.items()
-            if station_id in new_station_ids
-        }
+    async def _upsert_stations(self, stations: {str, Station}, update_existing: bool = True) -> (int, int):
+        if not stations:
+            return 0, 0
+
+        # one multi-row upsert; attributes missing from the source (e.g. gbfs without a capacity)
+        # never overwrite known values, and unchanged rows are not touched, so only genuinely
+        # new or changed stations come back from RETURNING
+        statement = insert(sql.stations).values([dataclasses.asdict(station) for station in stations.values()])
+        if update_existing:
+            updates = {
+                column.name: sa.func.coalesce(statement.excluded[column.name], column)
+                for column in sql.stations.columns if column.name != 'id'
+            }
+            statement = statement.on_conflict_do_update(
+                index_elements=[sql.stations.c.id],
+                set_=updates,
+                where=sa.or_(*[sql.stations.c[name].is_distinct_from(value) for name, value in updates.items()]),
+            )
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=[sql.stations.c.id])
+        statement = statement.returning(*sql.stations.columns, sa.literal_column('xmax = 0').label('inserted'))
 
-        # insert new station in database
         async with self.conn() as conn:
-            for station in new_stations.values():
-                statement = sql.stations.insert().values(**dataclasses.asdict(station))
-                await conn.execute(statement)
+            result = await conn.execute(statement)
+            rows = await result.fetchall()
+
+            # the registry takes the rows as stored, not the submitted ones, which may lack the
+            # attributes the table has (stations from trips have no capacity, kiosk or region);
+            # stations another importer inserted first are not returned and are read back
+            returned_ids = {row.id for row in rows}
+            unknown_ids = station_registry.missing(set(stations) - returned_ids)
+            if unknown_ids:
+                result = await conn.execute(sa.select([sql.stations]).where(sql.stations.c.id.in_(unknown_ids)))
+                known_rows = await result.fetchall()
+            else:
+                known_rows = []
+        station_registry.update(rows)
+        station_registry.add(known_rows)
+
+        inserted_ids = [row.id for row in rows if row.inserted]
+        updated_ids = [row.id for row in rows if not row.inserted]
 
         # logging
-        if new_stations:
+        if rows:
             logger.info(
-                f'Station -- found {len(new_stations)} new stations: {new_stations.keys()}.'
+                f'Station -- inserted {len(inserted_ids)} new stations: {inserted_ids}, '
+                f'updated {len(updated_ids)} stations: {updated_ids}.'
             )
         else:
-            logger.info('Station -- no new station found.')
+            logger.info('Station -- no new or changed station found.')
+        return len(inserted_ids), len(updated_ids)
 
 
 class TripDataCSVColumn:
@@ -112,41 +157,159 @@ class TripDataCSVColumn:
     USER_GENDER = 'gender'
 
 
+TRIP_COPY_COLUMNS = [
+    column.name for column in sql.trips.columns if column.name not in ('predicted_trip_duration', 'actuals_batch_id')
+]
+
+# the trips inserted by a chunk, as returned by the insert of TripDataImporter.load_trips
+AGGREGATE_SOURCE = sa.table(
+    'inserted',
+    sa.column('start_station_id'),
+    sa.column('start_time'),
+    sa.column('user_type'),
+    sa.column('trip_duration'),
+)
+# staged trips whose (id, start_time) is taken by a trip with another natural key
+TRIP_ID_COLLISIONS_SQL = (
+    f'SELECT count(*) FROM trips_staging staged '
+    f'JOIN {sql.trips.name} existing ON existing.id = staged.id AND existing.start_time = staged.start_time '
+    f'WHERE (existing.bike_id, existing.start_station_id) IS DISTINCT FROM (staged.bike_id, staged.start_station_id)'
+)
+MERGE_AGGREGATES_SQL = str(sql.merge_trip_aggregates(AGGREGATE_SOURCE).compile(
+    dialect=postgresql.psycopg2.dialect(), compile_kwargs={'literal_binds': True}
+))
+
+
 class TripDataImporter(StationDataImporter):
-    def __init__(self, path: Path, *args, **kwargs):
+    def __init__(self, source: typing.Union[Path, typing.BinaryIO], *args, file_name: str = None,
+                 content_hash: str = None, columnar: bool = True, chunk_size: int = None,
+                 max_memory: int = None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.file_name = path.name
-        self.data_frame = pandas.read_csv(path)
+        self.source = source
+        self.file_name = file_name or getattr(source, 'name', None) or repr(source)
+        if isinstance(source, Path):
+            self.file_name = source.name
+        self.content_hash = content_hash
+        self.columnar = columnar
+        self.chunk_size = chunk_size
+        self.max_memory = max_memory
+        self._connection = None
+        self._owns_source = False
+
+    @classmethod
+    def from_zip_member(cls, zip_file: zipfile.ZipFile, member: zipfile.ZipInfo, *args, **kwargs):
+        # the member is decompressed while it is parsed, nothing is extracted to disk; its crc
+        # and size from the archive directory are a free content hash
+        importer = cls(
+            zip_file.open(member), *args,
+            file_name=Path(member.filename).name,
+            content_hash=f'crc32:{member.CRC:08x}:{member.file_size}',
+            **kwargs
+        )
+        importer._owns_source = True
+        return importer
 
     async def run(self):
-        if await self.is_already_imported():
+        # parsing runs in the default executor and database writes in the blocking executor,
+        # so several files can be imported concurrently without blocking the event loop
+        loop = asyncio.get_event_loop()
+        if self.content_hash is None and isinstance(self.source, Path):
+            self.content_hash = await loop.run_in_executor(None, _file_hash, self.source)
+
+        committed_rows = await self.start_manifest()
+        if committed_rows is None:
             logger.info(f'Trip[{self.file_name}] -- Already Imported.')
+            if self._owns_source:
+                self.source.close()
             return
 
-        logger.info(f'Trip[{self.file_name}] -- Import Started.')
-        await self.insert_stations()
-        self.insert_trips()
-        logger.info(f'Trip[{self.file_name}] -- Import Finished.')
+        if committed_rows:
+            logger.info(f'Trip[{self.file_name}] -- Resuming Import after {committed_rows} rows.')
+        else:
+            logger.info(f'Trip[{self.file_name}] -- Import Started.')
+
+        imported_count = 0
+        chunks = self.read_chunks(skip_rows=committed_rows)
+        try:
+            while True:
+                data_frame = await loop.run_in_executor(None, next, chunks, None)
+                if data_frame is None:
+                    break
+
+                await self.insert_stations(data_frame)
+                insert = self.copy_trips if self.columnar else self.insert_trips
+                await run_blocking(insert, data_frame)
+                imported_count += len(data_frame)
+        finally:
+            chunks.close()
+            if self._owns_source:
+                self.source.close()
+            self.close()
 
-    async def is_already_imported(self):
-        start_time = self.data_frame[TripDataCSVColumn.START_TIME]
-        min_start_time, max_start_time = start_time.min(), start_time.max()
+        await self.finish_manifest()
+        logger.info(f'Trip[{self.file_name}] -- Import Finished, imported {imported_count} rows.')
 
-        # get count of trips between start and end date
+    def read_chunks(self, skip_rows: int = 0) -> typing.Iterator[pandas.DataFrame]:
+        # rows committed by a previous attempt are skipped
+        return read_csv_chunks(self.source, self.chunk_size, self.max_memory, skip_rows)
+
+    async def start_manifest(self) -> typing.Optional[int]:
+        # returns the number of rows to skip, or None when the file is already fully imported
         async with self.conn() as conn:
-            statement = sa.select([
-                sa.func.count(sql.trips.c.id).label('count')
-            ]).where(sa.and_(
-                sql.trips.c.start_time >= min_start_time,
-                sql.trips.c.start_time <= max_start_time,
+            result = await conn.execute(
+                sa.select([sql.imports]).where(sql.imports.c.file_name == self.file_name)
+            )
+            manifest = await result.first()
+
+            # a source without a hash (a plain stream) cannot be told apart from another file of
+            # the same name, so it is always imported in full
+            if manifest is not None and self.content_hash is not None and manifest.content_hash == self.content_hash:
+                return None if manifest.completed else manifest.committed_rows
+
+            # first import of the file, its content changed since it was last seen, or its content is
+            # unknown; files loaded before the manifest existed land here too, and re-importing them
+            # only skips their trips by id
+            statement = insert(sql.imports).values(
+                file_name=self.file_name,
+                content_hash=self.content_hash,
+                committed_rows=0,
+                completed=False,
+            )
+            statement = statement.on_conflict_do_update(
+                index_elements=[sql.imports.c.file_name],
+                set_={
+                    'content_hash': statement.excluded.content_hash,
+                    'row_count': None,
+                    'committed_rows': 0,
+                    'completed': False,
+                    'updated_at': sa.func.now(),
+                },
+            )
+            await conn.execute(statement)
+        return 0
+
+    async def finish_manifest(self):
+        async with self.conn() as conn:
+            await conn.execute(sql.imports.update().where(
+                sql.imports.c.file_name == self.file_name
+            ).values(
+                row_count=sql.imports.c.committed_rows,
+                completed=True,
+                updated_at=sa.func.now(),
             ))
-            result = await conn.execute(statement)
-            count = await result.scalar()
 
-        return count >= len(self.data_frame)
+    def _record_progress_statement(self, row_count: int):
+        # executed in the same transaction as the rows it accounts for
+        return sql.imports.update().where(
+            sql.imports.c.file_name == self.file_name
+        ).values(
+            committed_rows=sql.imports.c.committed_rows + row_count,
+            updated_at=sa.func.now(),
+        )
 
-    def _extract_stations(self, id_column, name_column, latitude_column, longitude_column) -> {str, Station}:
-        grouped = self.data_frame.groupby([id_column]).first()
+    @staticmethod
+    def _extract_stations(data_frame, id_column, name_column, latitude_column, longitude_column) -> {str, Station}:
+        grouped = data_frame.groupby([id_column]).first()
         return {
             str(station_id): Station(**{
                 'id': str(station_id),
@@ -156,32 +319,58 @@ class TripDataImporter(StationDataImporter):
             }) for station_id, data in grouped.iterrows()
         }
 
-    async def insert_stations(self):
-        stations = self._extract_stations(
+    @classmethod
+    def stations_from_trips(cls, data_frame: pandas.DataFrame) -> {str, Station}:
+        stations = cls._extract_stations(
+            data_frame,
             id_column=TripDataCSVColumn.START_STATION_ID,
             name_column=TripDataCSVColumn.START_STATION_NAME,
             latitude_column=TripDataCSVColumn.START_STATION_LATITUDE,
             longitude_column=TripDataCSVColumn.START_STATION_LONGITUDE,
         )
-        stations.update(self._extract_stations(
+        stations.update(cls._extract_stations(
+            data_frame,
             id_column=TripDataCSVColumn.END_STATION_ID,
             name_column=TripDataCSVColumn.END_STATION_NAME,
             latitude_column=TripDataCSVColumn.END_STATION_LATITUDE,
             longitude_column=TripDataCSVColumn.END_STATION_LONGITUDE,
         ))
-        await self._upsert_stations(stations)
+        return stations
 
-    def insert_trips(self):
+    async def insert_stations(self, data_frame: pandas.DataFrame):
+        # trip files only know names and coordinates, which gbfs keeps more current; stations
+        # already in the registry need no round trip
+        stations = self.stations_from_trips(data_frame)
+        new_station_ids = station_registry.missing(stations)
+        await self._upsert_stations(
+            {station_id: stations[station_id] for station_id in new_station_ids}, update_existing=False
+        )
+
+    def insert_trips(self, data_frame: pandas.DataFrame):
         gender_map = {0: 'Male', 1: 'Female'}
-        total_count = len(self.data_frame)
+        total_count = len(data_frame)
         chunck_size = 1000
+        conn = self.create_engine().connect()
+        transaction = conn.begin()
+
+        ids = trip_ids(
+            data_frame[TripDataCSVColumn.BIKE_ID],
+            data_frame[TripDataCSVColumn.START_TIME],
+            data_frame[TripDataCSVColumn.START_STATION_ID],
+        )
+        statement = insert(sql.trips).on_conflict_do_nothing(
+            index_elements=[sql.trips.c.id, sql.trips.c.start_time]
+        ).returning(sql.trips.c.id)
+        sql.ensure_trip_partitions(self.create_engine(), self.trip_months(data_frame))
+        collision_count = 0
 
         for offset in range(0, total_count, chunck_size):
             # convert the chunk to a list of Trip
             trips = []
-            for index, row in self.data_frame[offset:offset + chunck_size].iterrows():
+            chunk_ids = ids[offset:offset + chunck_size]
+            for trip_id, (index, row) in zip(chunk_ids, data_frame[offset:offset + chunck_size].iterrows()):
                 trip = {
-                    'id': str(uuid4()),
+                    'id': int(trip_id),
                     'trip_duration': row[TripDataCSVColumn.TRIP_DURATION],
                     'start_station_id': row[TripDataCSVColumn.START_STATION_ID],
                     'end_station_id': row[TripDataCSVColumn.END_STATION_ID],
@@ -194,13 +383,163 @@ class TripDataImporter(StationDataImporter):
                 }
                 trips.append(trip)
 
-            # upsert into database
-            conn = self.create_engine().connect()
-            conn.execute(sql.trips.insert(), trips)
+            # upsert into database, the aggregates only count the trips that were not there yet
+            inserted_ids = [row.id for row in conn.execute(statement.values(trips))]
+            if len(inserted_ids) < len(trips):
+                collision_count += self._count_id_collisions(conn, trips, set(inserted_ids))
+            if inserted_ids:
+                conn.execute(sql.merge_trip_aggregates(
+                    sa.select([sql.trips]).where(sql.trips.c.id.in_(inserted_ids)).alias('inserted')
+                ))
 
             # logging
             progress = (offset + chunck_size) / total_count
             logger.info((
                 f'Trip[{self.file_name}] -- '
                 f'Import in Progress: {progress:.2%}({offset+chunck_size}/{total_count})'
-            ))
\ No newline at end of file
+            ))
+
+        conn.execute(self._record_progress_statement(total_count))
+        transaction.commit()
+        conn.close()
+        self._log_id_collisions(collision_count)
+
+    @staticmethod
+    def _count_id_collisions(conn, trips: [dict], inserted_ids: typing.Set[int]) -> int:
+        # the skipped trips no row with the same id matches on bike and start station
+        skipped = [trip for trip in trips if trip['id'] not in inserted_ids]
+        existing = {}
+        for row in conn.execute(sa.select([
+            sql.trips.c.id, sql.trips.c.bike_id, sql.trips.c.start_station_id,
+        ]).where(sql.trips.c.id.in_([trip['id'] for trip in skipped]))):
+            existing.setdefault(row.id, set()).add((int(row.bike_id), str(row.start_station_id)))
+        return sum(
+            (int(trip['bike_id']), str(trip['start_station_id'])) not in existing.get(trip['id'], set())
+            for trip in skipped
+        )
+
+    def copy_trips(self, data_frame: pandas.DataFrame, chunk_size=50000):
+        self.load_trips(self.encode_trips(data_frame, chunk_size), len(data_frame), self.trip_months(data_frame))
+
+    @staticmethod
+    def trip_months(data_frame: pandas.DataFrame) -> [datetime]:
+        # the months a chunk has trips in, i.e. the trips partitions it loads into
+        start_times = pandas.to_datetime(data_frame[TripDataCSVColumn.START_TIME])
+        return [month.to_pydatetime() for month in start_times.dt.to_period('M').dt.start_time.unique()]
+
+    @classmethod
+    def encode_trips(cls, data_frame: pandas.DataFrame, chunk_size=50000) -> [(str, int)]:
+        # convert the chunks to trip columns and encode them as csv, ready for COPY
+        buffers = []
+        for offset in range(0, len(data_frame), chunk_size):
+            trips = cls._to_trip_frame(data_frame[offset:offset + chunk_size])
+            buffers.append((trips[TRIP_COPY_COLUMNS].to_csv(index=False, header=False), len(trips)))
+        return buffers
+
+    def load_trips(self, buffers: [(str, int)], total_count: int, months: [datetime] = ()):
+        # the partitions of `months` are created up front, outside of the load transaction
+        sql.ensure_trip_partitions(self.create_engine(), months)
+        column_list = ', '.join(TRIP_COPY_COLUMNS)
+        statement = f'COPY trips_staging ({column_list}) FROM STDIN WITH (FORMAT csv)'
+        started_at = time.perf_counter()
+
+        # one connection is reused for every chunk of the file
+        if self._connection is None:
+            self._connection = self.create_engine().raw_connection()
+        connection = self._connection
+
+        with connection.cursor() as cursor:
+            # COPY cannot skip conflicts, rows are staged in a session-local table first
+            cursor.execute(
+                f'CREATE TEMP TABLE IF NOT EXISTS trips_staging '
+                f'(LIKE {sql.trips.name} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS'
+            )
+
+            imported_count = 0
+            for buffer, row_count in buffers:
+                # stream into database
+                cursor.copy_expert(statement, io.StringIO(buffer))
+
+                # logging
+                imported_count += row_count
+                progress = imported_count / total_count
+                logger.info((
+                    f'Trip[{self.file_name}] -- '
+                    f'Import in Progress: {progress:.2%}({imported_count}/{total_count})'
+                ))
+
+            # trips that are already in the table (a retried chunk) are skipped by their ids, only
+            # the trips actually inserted are added to the aggregates, in the same statement
+            cursor.execute(
+                f'WITH inserted AS ('
+                f'INSERT INTO {sql.trips.name} ({column_list}) '
+                f'SELECT {column_list} FROM trips_staging ON CONFLICT (id, start_time) DO NOTHING '
+                f'RETURNING {", ".join(column.name for column in AGGREGATE_SOURCE.columns)}'
+                f'), aggregated AS ({MERGE_AGGREGATES_SQL}) '
+                f'SELECT count(*) FROM inserted'
+            )
+            inserted_count = cursor.fetchone()[0]
+
+            # a skipped row is a trip imported before, or a different trip whose hashed id collides
+            # with one in the table; only collisions differ in their natural key
+            collision_count = 0
+            if inserted_count < total_count:
+                cursor.execute(TRIP_ID_COLLISIONS_SQL)
+                collision_count = cursor.fetchone()[0]
+
+            # the chunk and the manifest progress are committed together, so a crashed import
+            # resumes right after the last committed chunk
+            progress_statement = self._record_progress_statement(total_count).compile(
+                dialect=postgresql.psycopg2.dialect()
+            )
+            cursor.execute(str(progress_statement), progress_statement.params)
+        connection.commit()
+
+        elapsed = time.perf_counter() - started_at
+        logger.info(
+            f'Trip[{self.file_name}] -- Copied {total_count} rows in {elapsed:.2f}s '
+            f'({total_count / elapsed if elapsed else 0:.0f} rows/s), '
+            f'{total_count - inserted_count} already existed.'
+        )
+        self._log_id_collisions(collision_count)
+
+    def _log_id_collisions(self, collision_count: int):
+        if collision_count:
+            logger.warning(
+                f'Trip[{self.file_name}] -- {collision_count} trips were skipped because their id '
+                f'collides with a different trip.'
+            )
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @staticmethod
+    def _to_trip_frame(data_frame: pandas.DataFrame) -> pandas.DataFrame:
+        gender_map = {0: 'Male', 1: 'Female'}
+        return pandas.DataFrame({
+            'id': trip_ids(
+                data_frame[TripDataCSVColumn.BIKE_ID],
+                data_frame[TripDataCSVColumn.START_TIME],
+                data_frame[TripDataCSVColumn.START_STATION_ID],
+            ),
+            'trip_duration': data_frame[TripDataCSVColumn.TRIP_DURATION].to_numpy(),
+            'start_station_id': data_frame[TripDataCSVColumn.START_STATION_ID].to_numpy(),
+            'end_station_id': data_frame[TripDataCSVColumn.END_STATION_ID].to_numpy(),
+            'start_time': data_frame[TripDataCSVColumn.START_TIME].to_numpy(),
+            'stop_time': data_frame[TripDataCSVColumn.STOP_TIME].to_numpy(),
+            'bike_id': data_frame[TripDataCSVColumn.BIKE_ID].to_numpy(),
+            'user_type': data_frame[TripDataCSVColumn.USER_TYPE].to_numpy(),
+            'user_birth_year': data_frame[TripDataCSVColumn.USER_BIRTH_YEAR].to_numpy(),
+            'user_gender': data_frame[TripDataCSVColumn.USER_GENDER].map(gender_map).fillna('Other').to_numpy(),
+            'submitted_actual': False,
+        })
+
+
+def _file_hash(path: Path) -> str:
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return f'sha1:{digest.hexdigest()}'
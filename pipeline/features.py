@@ -0,0 +1,89 @@
+import functools
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.holiday import USFederalHolidayCalendar
+
+# features derived from the trip columns, added by `build_features` for training and scoring alike
+FEATURE_COLUMNS = (
+    'hour',
+    'day_of_week',
+    'is_weekend',
+    'is_holiday',
+    'age',
+    'distance',
+)
+
+CATEGORY_COLUMNS = (
+    'start_station_id',
+    'start_station_name',
+    'end_station_name',
+    'station_region_id',
+    'user_type',
+)
+
+COORDINATE_COLUMNS = (
+    'start_station_latitude',
+    'start_station_longitude',
+    'end_station_latitude',
+    'end_station_longitude',
+)
+
+EARTH_RADIUS_KM = 6371.0088
+MAX_AGE = 100
+
+
+def build_features(frame: pd.DataFrame) -> pd.DataFrame:
+    # one pass over whole columns: expects `start_time`, `birth_year` and the COORDINATE_COLUMNS,
+    # returns a copy with FEATURE_COLUMNS added and the CATEGORY_COLUMNS present made categorical
+    frame = frame.copy()
+    start_times = pd.to_datetime(frame['start_time'])
+    frame['start_time'] = start_times
+
+    frame['hour'] = start_times.dt.hour.astype('int8')
+    frame['day_of_week'] = start_times.dt.dayofweek.astype('int8')
+    frame['is_weekend'] = frame['day_of_week'] >= 5
+    frame['is_holiday'] = start_times.dt.normalize().isin(_holidays(start_times.min(), start_times.max()))
+
+    # unknown or implausible birth years (the csv files use placeholders like 1900) have no age
+    age = start_times.dt.year - pd.to_numeric(frame['birth_year'], errors='coerce')
+    frame['age'] = age.where((age >= 0) & (age <= MAX_AGE)).astype('float32')
+
+    frame['distance'] = haversine(*(
+        pd.to_numeric(frame[column], errors='coerce').to_numpy(dtype=np.float64) for column in COORDINATE_COLUMNS
+    )).astype('float32')
+
+    for column in CATEGORY_COLUMNS:
+        if column in frame:
+            frame[column] = frame[column].astype('category')
+    return frame
+
+
+def haversine(latitude1, longitude1, latitude2, longitude2) -> np.ndarray:
+    # great circle distance in kilometres, NaN wherever a coordinate is missing
+    latitude1, longitude1, latitude2, longitude2 = map(np.radians, (latitude1, longitude1, latitude2, longitude2))
+    a = (
+        np.sin((latitude2 - latitude1) / 2) ** 2
+        + np.cos(latitude1) * np.cos(latitude2) * np.sin((longitude2 - longitude1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def to_records(frame: pd.DataFrame, columns) -> [dict]:
+    # json ready dicts: python scalars instead of numpy ones, None instead of NaN
+    values = []
+    for column in columns:
+        series = frame[column]
+        values.append(series.astype(object).where(series.notna(), None).tolist())
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+@functools.lru_cache(maxsize=16)
+def _holiday_range(start_year: int, end_year: int) -> pd.DatetimeIndex:
+    return USFederalHolidayCalendar().holidays(start=f'{start_year}-01-01', end=f'{end_year}-12-31')
+
+
+def _holidays(start: pd.Timestamp, end: pd.Timestamp) -> pd.DatetimeIndex:
+    if pd.isna(start) or pd.isna(end):
+        return pd.DatetimeIndex([])
+    return _holiday_range(start.year, end.year)
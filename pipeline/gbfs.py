@@ -0,0 +1,92 @@
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass, asdict
+from pathlib import Path
+
+from aiohttp import ClientResponseError, ClientSession
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedFeed:
+    data: dict
+    fetched_at: float
+    ttl: int = 0
+    etag: str = None
+    last_modified: str = None
+
+    @property
+    def is_fresh(self) -> bool:
+        return time.time() < self.fetched_at + self.ttl
+
+
+class GBFSFeedCache:
+    def __init__(self, cache_dir='data/gbfs_cache'):
+        self.cache_dir = Path(cache_dir)
+        self._feeds = {}
+
+    async def fetch(self, session: ClientSession, url: str) -> dict:
+        feed = self._feeds.get(url) or self._read(url)
+        if feed is not None and feed.is_fresh:
+            logger.debug(f'GBFS -- {url} served from cache.')
+            return feed.data
+
+        # revalidate what we have, so an unchanged feed costs an empty 304 response
+        headers = {}
+        if feed is not None and feed.etag:
+            headers['If-None-Match'] = feed.etag
+        if feed is not None and feed.last_modified:
+            headers['If-Modified-Since'] = feed.last_modified
+
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304 and feed is not None:
+                logger.debug(f'GBFS -- {url} not modified.')
+                feed.fetched_at = time.time()
+            elif response.status != 200:
+                # error responses are never cached, the last good feed is served until the feed recovers
+                if feed is None:
+                    raise ClientResponseError(
+                        response.request_info, response.history, status=response.status, message=response.reason
+                    )
+                logger.warning(f'GBFS -- {url} returned {response.status}, serving the cached feed.')
+                return feed.data
+            else:
+                data = await response.json()
+                feed = CachedFeed(
+                    data=data,
+                    fetched_at=time.time(),
+                    ttl=int(data.get('ttl', 0) or 0),
+                    etag=response.headers.get('ETag'),
+                    last_modified=response.headers.get('Last-Modified'),
+                )
+
+        self._feeds[url] = feed
+        self._write(url, feed)
+        return feed.data
+
+    def _path(self, url: str) -> Path:
+        return self.cache_dir.joinpath(hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+    def _read(self, url: str):
+        try:
+            with open(self._path(url)) as file:
+                return CachedFeed(**json.load(file))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _write(self, url: str, feed: CachedFeed):
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            path = self._path(url)
+            temp_path = path.with_suffix('.tmp')
+            with open(temp_path, 'w') as file:
+                json.dump(asdict(feed), file)
+            temp_path.replace(path)
+        except OSError as e:
+            logger.warning(f'GBFS -- unable to cache {url}: {e}')
+
+
+feed_cache = GBFSFeedCache()
@@ -0,0 +1,34 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    def __init__(self, threshold: float = 0.1, interval: float = 0.5):
+        self.threshold = threshold
+        self.interval = interval
+        self.stall_count = 0
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+
+    async def run(self):
+        # a sleep that wakes up late means something blocked the loop for the difference
+        while True:
+            started_at = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - started_at - self.interval
+
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.stall_count += 1
+                logger.warning(f'Event loop stalled for {lag * 1000:.0f}ms.')
+
+    def snapshot(self) -> dict:
+        return {
+            'stall_count': self.stall_count,
+            'max_lag': self.max_lag,
+            'last_lag': self.last_lag,
+        }
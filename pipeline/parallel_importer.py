@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import typing
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from queue import Full
+
+from data_sources import read_csv_chunks
+from entities import Station
+from sql import DatabaseMixin
+from .base import run_blocking
+from .data_importer import StationDataImporter, TripDataImporter
+from .station_registry import station_registry
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TransformedChunk:
+    file_name: str
+    sequence: int
+    row_count: int = 0
+    stations: typing.Dict[str, Station] = None
+    buffers: typing.List[typing.Tuple[str, int]] = None
+    months: typing.List[datetime] = None
+    done: bool = False
+    error: str = None
+
+
+def transform_member(zip_path: str, member_name: str, chunk_size: int, skip_rows: int, queue, stop):
+    # runs in a worker process: parse and transform one archive member, handing every chunk to
+    # the loaders through the bounded queue, which blocks the worker while the loaders catch up;
+    # a stopped run ends the worker at its next chunk
+    file_name = Path(member_name).name
+    sequence = 0
+    try:
+        with zipfile.ZipFile(zip_path) as zip_file, zip_file.open(member_name) as source:
+            for data_frame in read_csv_chunks(source, chunk_size, skip_rows=skip_rows):
+                if not _put_chunk(queue, stop, TransformedChunk(
+                    file_name=file_name,
+                    sequence=sequence,
+                    row_count=len(data_frame),
+                    stations=TripDataImporter.stations_from_trips(data_frame),
+                    buffers=TripDataImporter.encode_trips(data_frame),
+                    months=TripDataImporter.trip_months(data_frame),
+                )):
+                    return
+                sequence += 1
+        _put_chunk(queue, stop, TransformedChunk(file_name=file_name, sequence=sequence, done=True))
+    except Exception as e:
+        _put_chunk(queue, stop, TransformedChunk(file_name=file_name, sequence=sequence, done=True, error=repr(e)))
+
+
+def _put_chunk(queue, stop, chunk: TransformedChunk) -> bool:
+    while not stop.is_set():
+        try:
+            queue.put(chunk, timeout=1)
+            return True
+        except Full:
+            continue
+    return False
+
+
+class ParallelTripImporter(DatabaseMixin):
+    def __init__(self, zip_path='./data/data.zip', *args, workers: int = None, loaders: int = 2,
+                 queue_size: int = None, chunk_size: int = 100000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.zip_path = str(zip_path)
+        self.workers = workers or os.cpu_count() or 1
+        self.loaders = loaders
+        self.queue_size = queue_size or self.workers * 2
+        self.chunk_size = chunk_size
+
+        self._importers: typing.Dict[str, TripDataImporter] = {}
+        self._next_sequence: typing.Dict[str, int] = {}
+        self._imported_counts: typing.Dict[str, int] = {}
+        self._sequence_condition: asyncio.Condition = None
+        self._station_lock: asyncio.Lock = None
+        self._failed_files: typing.Set[str] = set()
+
+    async def run(self):
+        # gbfs stations are upserted once up front and loaded into the registry, trip files only
+        # add stations gbfs lacks
+        await StationDataImporter().run()
+
+        pending = await self._start_manifests()
+        if not pending:
+            logger.info('Trip -- all files already imported.')
+            return
+
+        self._sequence_condition = asyncio.Condition()
+        self._station_lock = asyncio.Lock()
+        loop = asyncio.get_event_loop()
+
+        with multiprocessing.Manager() as manager, ProcessPoolExecutor(self.workers) as executor:
+            queue = manager.Queue(self.queue_size)
+            stop = manager.Event()
+            loaders = [loop.create_task(self._load(queue)) for _ in range(self.loaders)]
+            try:
+                transforms = [
+                    loop.run_in_executor(
+                        executor, transform_member, self.zip_path, member_name, self.chunk_size, skip_rows, queue, stop
+                    ) for member_name, skip_rows in pending
+                ]
+                await asyncio.gather(*transforms)
+            except BaseException:
+                # a broken worker pool or a cancelled run: the workers and loaders stop, chunks not
+                # loaded yet are dropped and a rerun resumes every file from its manifest
+                stop.set()
+                for loader in loaders:
+                    loader.cancel()
+                raise
+            finally:
+                # the loaders stop once the queue drains, so do the executor threads a cancelled
+                # loader leaves blocked in queue.get; nothing blocks in get while the queue is full
+                for _ in loaders:
+                    try:
+                        await loop.run_in_executor(None, queue.put, None, not stop.is_set())
+                    except Full:
+                        break
+                await asyncio.gather(*loaders, return_exceptions=stop.is_set())
+                for importer in self._importers.values():
+                    importer.close()
+
+    async def _start_manifests(self) -> [(str, int)]:
+        pending = []
+        with zipfile.ZipFile(self.zip_path) as zip_file:
+            members = sorted(
+                (member for member in zip_file.infolist() if member.filename.endswith('.csv')),
+                key=lambda member: member.filename,
+            )
+
+        for member in members:
+            file_name = Path(member.filename).name
+            importer = TripDataImporter(
+                None, file_name=file_name, content_hash=f'crc32:{member.CRC:08x}:{member.file_size}'
+            )
+            committed_rows = await importer.start_manifest()
+            if committed_rows is None:
+                logger.info(f'Trip[{file_name}] -- Already Imported.')
+                continue
+
+            logger.info(f'Trip[{file_name}] -- Import Queued, skipping {committed_rows} committed rows.')
+            self._importers[file_name] = importer
+            self._next_sequence[file_name] = 0
+            self._imported_counts[file_name] = 0
+            pending.append((member.filename, committed_rows))
+        return pending
+
+    async def _load(self, queue):
+        loop = asyncio.get_event_loop()
+        while True:
+            chunk: TransformedChunk = await loop.run_in_executor(None, queue.get)
+            if chunk is None:
+                return
+
+            # chunks of one file are committed in order, the manifest resumes from a row count
+            async with self._sequence_condition:
+                await self._sequence_condition.wait_for(
+                    lambda: self._next_sequence[chunk.file_name] == chunk.sequence
+                )
+
+            importer = self._importers[chunk.file_name]
+            try:
+                if chunk.file_name in self._failed_files:
+                    # later chunks of a failed file are dropped, a rerun resumes from the manifest
+                    continue
+                elif chunk.error is not None:
+                    self._failed_files.add(chunk.file_name)
+                    logger.error(f'Trip[{chunk.file_name}] -- Import Failed: {chunk.error}')
+                elif chunk.done:
+                    await importer.finish_manifest()
+                    logger.info(
+                        f'Trip[{chunk.file_name}] -- Import Finished, '
+                        f'imported {self._imported_counts[chunk.file_name]} rows.'
+                    )
+                else:
+                    await self._insert_new_stations(chunk.stations)
+                    await run_blocking(importer.load_trips, chunk.buffers, chunk.row_count, chunk.months)
+                    self._imported_counts[chunk.file_name] += chunk.row_count
+            except Exception as e:
+                self._failed_files.add(chunk.file_name)
+                logger.error(f'Trip[{chunk.file_name}] -- Import Failed: {e}')
+            finally:
+                async with self._sequence_condition:
+                    self._next_sequence[chunk.file_name] += 1
+                    self._sequence_condition.notify_all()
+
+    async def _insert_new_stations(self, stations: typing.Dict[str, Station]):
+        # each station is upserted at most once across all workers and files
+        async with self._station_lock:
+            new_stations = {station_id: stations[station_id] for station_id in station_registry.missing(stations)}
+            if not new_stations:
+                return
+            await StationDataImporter()._upsert_stations(new_stations, update_existing=False)
@@ -0,0 +1,86 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from datetime import datetime
+
+from .base import ScoringBackend
+
+DEFAULT_KEY_FIELDS = ('start_station_id', 'user_type', 'birth_year', 'gender')
+
+
+@dataclass
+class CacheMetrics:
+    rows: int = 0
+    hits: int = 0
+    misses: int = 0
+    deduplicated: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.rows if self.rows else 0.0
+
+    def snapshot(self) -> dict:
+        return {**asdict(self), 'hit_rate': self.hit_rate}
+
+
+class CachedBackend(ScoringBackend):
+    # trips that share the same features (start station, time-of-day bucket, user type, birth year
+    # and gender by default) get the same prediction: it is requested once per batch and then
+    # served from an LRU cache until it expires
+    def __init__(self, backend: ScoringBackend, max_size: int = 10000, ttl: float = 3600,
+                 bucket_minutes: int = 60, key_fields: tuple = DEFAULT_KEY_FIELDS):
+        self.backend = backend
+        self.max_size = max_size
+        self.ttl = ttl
+        self.bucket_minutes = bucket_minutes
+        self.key_fields = key_fields
+        self.metrics = CacheMetrics()
+        self._entries = OrderedDict()
+
+    @property
+    def uses_features(self) -> bool:
+        return self.backend.uses_features
+
+    def cache_key(self, item: dict) -> tuple:
+        start_time = item['start_time']
+        if isinstance(start_time, str):
+            start_time = datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S.%f')
+        bucket = (start_time.hour * 60 + start_time.minute) // self.bucket_minutes
+        return (bucket, *(item.get(field) for field in self.key_fields))
+
+    async def predict(self, payload: [dict]) -> [float]:
+        now = time.monotonic()
+        keys = [self.cache_key(item) for item in payload]
+
+        # only the first trip of every uncached feature vector is sent to the backend
+        predictions = {}
+        missing = {}
+        for key, item in zip(keys, payload):
+            if key in predictions or key in missing:
+                self.metrics.deduplicated += 1
+                continue
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                predictions[key] = entry[0]
+            else:
+                missing[key] = item
+
+        if missing:
+            values = await self.backend.predict(list(missing.values()))
+            for key, value in zip(missing.keys(), values):
+                predictions[key] = value
+                self._store(key, value, now)
+
+        self.metrics.rows += len(payload)
+        self.metrics.misses += len(missing)
+        self.metrics.hits += len(payload) - len(missing)
+        return [predictions.get(key) for key in keys]
+
+    def _store(self, key: tuple, value: float, now: float):
+        self._entries[key] = (value, now + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.metrics.evictions += 1
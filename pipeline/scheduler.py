@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass, asdict
+
+from .scoring import Scoring, ScoringFailed
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SchedulerMetrics:
+    batches: int = 0
+    scored: int = 0
+    errors: int = 0
+    failed_rows: int = 0
+    queue_depth: int = 0
+    batch_size: int = 0
+    throughput: float = 0.0  # rows per second, exponentially weighted over recent batches
+
+    def record_batch(self, scored: int, elapsed: float):
+        self.batches += 1
+        self.scored += scored
+        if elapsed > 0:
+            rate = scored / elapsed
+            self.throughput = rate if self.batches == 1 else 0.8 * self.throughput + 0.2 * rate
+
+    def snapshot(self) -> dict:
+        return asdict(self)
+
+
+class AdaptiveScheduler:
+    def __init__(self, scoring: Scoring, min_batch_size: int = 100, max_batch_size: int = 5000,
+                 min_delay: float = 1.0, max_delay: float = 60.0):
+        self.scoring = scoring
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.metrics = SchedulerMetrics()
+
+    async def run(self):
+        delay = self.min_delay
+        while True:
+            try:
+                backlog = await self.scoring.backlog()
+                self.metrics.queue_depth = backlog
+                if backlog == 0:
+                    # idle: poll less and less often until the next trips show up
+                    await self._sleep(delay)
+                    delay = min(delay * 2, self.max_delay)
+                    continue
+
+                # batches grow with the backlog, and there is no pause while it is not drained
+                batch_size = min(max(backlog, self.min_batch_size), self.max_batch_size)
+                self.metrics.batch_size = batch_size
+                started_at = time.perf_counter()
+                scored = await self.scoring.predict(limit=batch_size)
+                self.metrics.record_batch(scored, time.perf_counter() - started_at)
+                self.metrics.queue_depth = max(backlog - scored, 0)
+                logger.info(f'Scoring -- {self.metrics.snapshot()}')
+
+                delay = self.min_delay
+                if scored < batch_size:
+                    await self._sleep(delay)
+            except Exception as e:
+                logger.error(e)
+                self.metrics.errors += 1
+                if isinstance(e, ScoringFailed):
+                    self.metrics.failed_rows += e.failed_count
+                delay = min(delay * 2, self.max_delay)
+                await self._sleep(delay)
+
+    @staticmethod
+    async def _sleep(delay: float):
+        # jitter keeps several schedulers from polling the database in lockstep
+        await asyncio.sleep(random.uniform(delay / 2, delay))
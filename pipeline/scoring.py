@@ -1,80 +1,197 @@
+import asyncio
 import logging
-import os
+import math
 from datetime import datetime, timedelta
 
 import aiohttp
-import pytz
-from aiohttp import BasicAuth
+import pandas as pd
 
-from database import Database, Trip
+from database import Database
+from .backends import ScoringBackend, create_backend
+from .base import run_blocking
+from .features import COORDINATE_COLUMNS, FEATURE_COLUMNS, build_features, to_records
+from .station_registry import station_registry
 
 logger = logging.getLogger(__name__)
 
+PREDICTION_PAYLOAD_COLUMNS = (
+    'trip_id',
+    'bike_id',
+    'birth_year',
+    'gender',
+    'start_station_id',
+    'start_station_name',
+    'end_station_name',
+    'start_time',
+    'station_capacity',
+    'station_has_kiosk',
+    'station_region_id',
+    'user_type',
+)
+
+# columns of Database.get_prediction_rows: the payload columns, then the station coordinates
+PREDICTION_ROW_COLUMNS = PREDICTION_PAYLOAD_COLUMNS + COORDINATE_COLUMNS
+
+
+class ScoringFailed(Exception):
+    # a Scoring.predict call whose batches all failed; the rows stay unscored and are retried
+    def __init__(self, failed_count: int, error: Exception):
+        super().__init__(f'{failed_count} rows failed to score: {error!r}')
+        self.failed_count = failed_count
+
 
 class Scoring:
-    def __init__(self, session: aiohttp.ClientSession):
+    def __init__(self, session: aiohttp.ClientSession, backend: ScoringBackend = None,
+                 request_size: int = 500, max_in_flight: int = 4):
         self.session = session
+        self.backend = backend or create_backend(session)
+        self.request_size = request_size
+        self.max_in_flight = max_in_flight
+        self._window_start: datetime = None
+
+    def prediction_window(self) -> (datetime, datetime):
+        # trips are replayed against the current minute of January 2020; the window starts where
+        # the last drained window ended, so minutes missed while busy or failing are caught up
+        now = datetime.utcnow()
+        current = now.replace(2020, 1, second=0, microsecond=0)
+        end = current + timedelta(minutes=1)
+        start = self._window_start if self._window_start is not None and self._window_start <= current else current
+        return start, end
 
-    async def predict(self):
+    async def backlog(self) -> int:
+        start_time_range = self.prediction_window()
+        return await run_blocking(self.count_prediction_backlog, start_time_range)
+
+    async def predict(self, limit: int = 100) -> int:
         # get prediction payload
-        payload = self.select_prediction_payload()
+        start_time_range = self.prediction_window()
+        payload = await run_blocking(self.select_prediction_payload, start_time_range, limit)
+        drained = len(payload) < limit
         if len(payload) == 0:
-            return
+            self._advance_window(start_time_range)
+            return 0
+
+        # up to `max_in_flight` requests are pending at once, and each batch is saved as soon as
+        # its own response arrives, while later batches are still being scored
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        batches = [payload[i:i + self.request_size] for i in range(0, len(payload), self.request_size)]
+        results = await asyncio.gather(
+            *[self._predict_batch(batch, semaphore) for batch in batches],
+            return_exceptions=True,
+        )
+
+        scored_count, failed_count, error = 0, 0, None
+        for batch, result in zip(batches, results):
+            if isinstance(result, Exception):
+                logger.error(f'Error making predictions: {result}')
+                failed_count += len(batch)
+                error = error or result
+            else:
+                scored_count += result
+        logger.info(f'{scored_count} rows were scored')
+        if hasattr(self.backend, 'metrics'):
+            logger.info(f'Prediction cache -- {self.backend.metrics.snapshot()}')
+
+        # the window only moves on once every trip in it was scored, failed batches are retried
+        # from the same start on the next call
+        if drained and scored_count == len(payload):
+            self._advance_window(start_time_range)
+        # with nothing scored the caller backs off, rather than resend rows the backend rejects
+        if failed_count and scored_count == 0:
+            raise ScoringFailed(failed_count, error) from error
+        return scored_count
 
-        # make predictions
-        response = await self._make_prediction_request(payload)
-        response_data = response.get('data', [])
+    def _advance_window(self, start_time_range):
+        # nothing older than the current minute is left unscored
+        self._window_start = start_time_range[1] - timedelta(minutes=1)
+
+    async def _predict_batch(self, payload: [dict], semaphore: asyncio.Semaphore) -> int:
+        async with semaphore:
+            predictions = await self.backend.predict(payload)
 
         trip_ids = [trip['trip_id'] for trip in payload]
-        predictions = [prediction['prediction'] for prediction in response_data]
-        predicted_values = dict(zip(trip_ids, predictions))
+        # missing, NaN or infinite predictions are never saved, their trips stay unscored
+        predicted_values = {
+            trip_id: prediction for trip_id, prediction in zip(trip_ids, predictions)
+            if prediction is not None and math.isfinite(prediction)
+        }
+
+        # save predicted values, the start times bound the trips partitions the update touches
+        start_times = [datetime.strptime(trip['start_time'], '%Y-%m-%d %H:%M:%S.%f') for trip in payload]
+        await run_blocking(self.save_predictions, predicted_values, (min(start_times), max(start_times)))
+        return len(predicted_values)
 
-        # save predicted values
+    @staticmethod
+    def save_predictions(predicted_values: dict, start_time_range=None):
         with Database() as database:
-            database.update_predicted_trip_duration(predicted_values)
+            database.update_predicted_trip_duration(predicted_values, start_time_range)
 
-        logger.info(f'{len(predicted_values)} rows were scored')
+    @staticmethod
+    def count_prediction_backlog(start_time_range) -> int:
+        with Database() as database:
+            return database.count_trip_data(start_time_range, without_predictions=True)
 
-    def select_prediction_payload(self) -> [dict]:
+    def select_prediction_payload(self, start_time_range=None, limit=100) -> [dict]:
+        start_time_range = start_time_range or self.prediction_window()
         with Database() as database:
-            now = datetime.utcnow().replace(tzinfo=pytz.utc)
-            start = now.replace(2020, 1, second=0, microsecond=0)
-            end = start + timedelta(minutes=1)
-            range = (start, end)
-            trips = database.get_trip_data(range, without_predictions=True)
-            return [self._assemble_prediction_payload(trip) for trip in trips]
+            rows = self.prediction_rows(database, start_time_range, limit)
+        return self._assemble_prediction_payloads(rows, self.backend.uses_features)
 
     @staticmethod
-    def _assemble_prediction_payload(trip: Trip):
-        return {
-            'trip_id': trip.id,
-            'bike_id': trip.bike_id,
-            'birth_year': trip.birth_year,
-            'gender': trip.gender,
-            'start_station_id': trip.start_station.id,
-            'start_station_name': trip.start_station_name,
-            'end_station_name': trip.end_station_name,
-            'start_time': trip.start_time.strftime('%Y-%m-%d %H:%M:%S.%f'),
-            'station_capacity': trip.start_station.capacity,
-            'station_has_kiosk': trip.start_station.has_kiosk,
-            'station_region_id': trip.start_station.region_id,
-            'user_type': trip.user_type,
-        }
+    def prediction_rows(database: Database, start_time_range, limit=100) -> [tuple]:
+        # the rows of Database.get_prediction_rows, with the stations looked up in the registry
+        # instead of joined; it is only (re)loaded when a trip references a station it lacks
+        trips = database.get_prediction_trip_rows(start_time_range, without_predictions=True, limit=limit)
+        station_ids = {trip.start_station_id for trip in trips} | {trip.end_station_id for trip in trips}
+        station_ids.discard(None)
+        if station_registry.missing(station_ids):
+            station_registry.load(database.connection)
 
-    async def _make_prediction_request(self, payload: list):
-        username = os.getenv('DATAROBOT_USERNAME')
-        api_endpoint = os.getenv('DATAROBOT_PRED_ENDPOINT')
-        api_token = os.getenv('DATAROBOT_API_TOKEN')
-        deployment_id = os.getenv('DEPLOYMENT_ID')
-        datarobot_key = os.getenv('DATAROBOT_KEY')
+        rows = []
+        for trip_id, bike_id, birth_year, gender, start_station_id, end_station_id, start_time, user_type in trips:
+            start_station = station_registry.get(start_station_id)
+            if start_station is None:
+                continue
+            end_station = station_registry.get(end_station_id) if end_station_id is not None else None
+            rows.append((
+                trip_id,
+                bike_id,
+                birth_year,
+                gender,
+                start_station_id,
+                start_station.name,
+                end_station.name if end_station else None,
+                start_time,
+                start_station.capacity,
+                start_station.has_kiosk,
+                start_station.region_id,
+                user_type,
+                start_station.latitude,
+                start_station.longitude,
+                end_station.latitude if end_station else None,
+                end_station.longitude if end_station else None,
+            ))
+        return rows
 
-        headers = {'datarobot-key': datarobot_key}
-        url = f'{api_endpoint}/deployments/{deployment_id}/predictions'
+    @staticmethod
+    def _assemble_prediction_payloads(rows: [tuple], with_features: bool = False) -> [dict]:
+        # rows come from Database.get_prediction_rows, in PREDICTION_ROW_COLUMNS order; the datarobot
+        # deployment scores the PREDICTION_PAYLOAD_COLUMNS only
+        if not with_features:
+            start_time_index = PREDICTION_PAYLOAD_COLUMNS.index('start_time')
+            payload = []
+            for row in rows:
+                item = dict(zip(PREDICTION_PAYLOAD_COLUMNS, row))
+                item['start_time'] = row[start_time_index].strftime('%Y-%m-%d %H:%M:%S.%f')
+                payload.append(item)
+            return payload
 
-        auth = BasicAuth(username, api_token)
-        async with self.session.post(url, auth=auth, headers=headers, json=payload) as resp:
-            if resp.status == 200:
-                return await resp.json()
-            else:
-                logger.error(f'Error making predictions: {await resp.json()}')
-                return []
+        # features are computed for the whole batch at once, the payload carries the raw
+        # columns plus FEATURE_COLUMNS
+        if not rows:
+            return []
+        frame = build_features(pd.DataFrame.from_records(rows, columns=PREDICTION_ROW_COLUMNS))
+        payload = to_records(frame, PREDICTION_PAYLOAD_COLUMNS + FEATURE_COLUMNS)
+        for item, start_time in zip(payload, frame['start_time'].dt.strftime('%Y-%m-%d %H:%M:%S.%f')):
+            item['start_time'] = start_time
+        return payload
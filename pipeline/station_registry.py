@@ -0,0 +1,119 @@
+import json
+import logging
+import threading
+import time
+import typing
+
+import pandas as pd
+import sqlalchemy as sa
+
+import sql
+
+logger = logging.getLogger(__name__)
+
+
+class StationRecord:
+    # one station, without a per instance __dict__; a few hundred of these are shared read-only by
+    # the importers, scoring and training
+    __slots__ = ('id', 'name', 'latitude', 'longitude', 'region_id', 'region_name', 'capacity', 'has_kiosk')
+
+    def __init__(self, id: str, name: str, latitude: float, longitude: float, region_id: str = None,
+                 region_name: str = None, capacity: int = None, has_kiosk: bool = None):
+        self.id = id
+        self.name = name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.region_id = region_id
+        self.region_name = region_name
+        self.capacity = capacity
+        self.has_kiosk = has_kiosk
+
+    @classmethod
+    def from_station(cls, station) -> 'StationRecord':
+        # anything with the station attributes: an entities.Station, a stations table row
+        return cls(*(getattr(station, name, None) for name in cls.__slots__))
+
+    def __repr__(self):
+        return f'StationRecord({", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)})'
+
+
+class StationRegistry:
+    # process-wide, read-mostly view of the stations table: readers look ids up in a plain dict
+    # without locking, writers build a new dict and swap the reference, so a reader sees either
+    # the old or the new stations but never a half refreshed mix
+    def __init__(self):
+        self._records: typing.Dict[str, StationRecord] = {}
+        self._lock = threading.Lock()
+        self.refreshed_at: float = None
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, station_id):
+        return str(station_id) in self._records
+
+    def get(self, station_id) -> StationRecord:
+        return self._records.get(str(station_id))
+
+    def missing(self, station_ids: typing.Iterable) -> typing.Set[str]:
+        records = self._records
+        return {str(station_id) for station_id in station_ids if str(station_id) not in records}
+
+    def replace(self, stations: typing.Iterable):
+        records = {}
+        for station in stations:
+            record = StationRecord.from_station(station)
+            records[str(record.id)] = record
+        with self._lock:
+            self._records = records
+            self.refreshed_at = time.time()
+        logger.info(f'Station registry -- {len(records)} stations loaded.')
+
+    def add(self, stations: typing.Iterable):
+        # stations already known keep their attributes, the next `replace` brings in changes
+        with self._lock:
+            records = dict(self._records)
+            for station in stations:
+                record = StationRecord.from_station(station)
+                records.setdefault(str(record.id), record)
+            self._records = records
+
+    def update(self, stations: typing.Iterable):
+        # stations already known take the new attributes
+        with self._lock:
+            records = dict(self._records)
+            for station in stations:
+                record = StationRecord.from_station(station)
+                records[str(record.id)] = record
+            self._records = records
+
+    def load(self, connection: sa.engine.Connection):
+        self.replace(connection.execute(sa.select([sql.stations])).fetchall())
+
+    def load_station_information(self, path='data/station_information.json', regions=None):
+        # a gbfs station_information document, the local snapshot for runs without a database
+        with open(path) as file:
+            items = json.load(file)['data']['stations']
+        self.replace(StationRecord(
+            id=str(item['station_id']),
+            name=item['name'],
+            latitude=item['lat'],
+            longitude=item['lon'],
+            region_id=str(item['region_id']) if item.get('region_id') is not None else None,
+            region_name=regions[int(item['region_id'])] if regions and item.get('region_id') is not None else None,
+            capacity=item.get('capacity'),
+            has_kiosk=item.get('has_kiosk'),
+        ) for item in items)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        # station columns joined into the training data, indexed by the integer ids of the trip
+        # csv files; stations with other ids never match a trip
+        records = [record for record in self._records.values() if str(record.id).isdigit()]
+        return pd.DataFrame({
+            'station_region_id': [record.region_id for record in records],
+            'station_capacity': pd.array([record.capacity for record in records], dtype='Int64'),
+            'station_has_kiosk': [record.has_kiosk for record in records],
+        }, index=pd.Index([int(record.id) for record in records]))
+
+
+station_registry = StationRegistry()
@@ -1,48 +1,124 @@
+import logging
+import os
 from os import listdir
 from os.path import isfile, join
+from pathlib import Path
 
 import pandas as pd
+import pyarrow as pa
 
-from data_sources import Regions, Stations
+from data_sources import Regions, read_csv_chunks
+from .columnar import PartitionManifest, PartitionWriter, encode_strings, partition_path
+from .features import COORDINATE_COLUMNS, build_features
+from .station_registry import station_registry
+
+logger = logging.getLogger(__name__)
 
 
 class TrainingData:
-    def __init__(self, dir_path='data/training/'):
-        self.stations = Stations()
+    def __init__(self, dir_path='data/training/', station_information_path='data/station_information.json'):
         self.regions = Regions()
         self.dir_path = dir_path
+        self.station_information_path = station_information_path
+
+    def _station_dataframe(self) -> pd.DataFrame:
+        # the registry is filled by the station import, standalone runs read the local gbfs snapshot
+        if not station_registry:
+            station_registry.load_station_information(self.station_information_path, self.regions)
+        return station_registry.to_dataframe()
 
     def _get_file_paths(self):
         files = sorted([join(self.dir_path, file) for file in listdir(self.dir_path)])
         return [file for file in files if isfile(file) and file.endswith('.csv')]
 
-    def process(self):
-        stations = self.stations.to_dataframe()
-        dataframes = []
+    def process(self, output_path='training.csv', chunk_size: int = None, max_memory: int = None,
+                output_format='csv'):
+        # chunks are written out as soon as they are transformed, so with a `chunk_size` or a
+        # `max_memory` ceiling (in bytes) only one chunk of one month is held in memory at a time
+        if output_format == 'parquet':
+            return self._process_parquet(Path(output_path).with_suffix(''), chunk_size, max_memory)
+
+        output = Path(output_path)
+        if output.exists():
+            output.unlink()
+
+        stations = self._station_dataframe()
+        row_count = 0
         for path in self._get_file_paths():
-            dataframe = pd.read_csv(path)
-            dataframe = dataframe.rename(columns={
-                'tripduration': 'trip_duration',
-                'starttime': 'start_time',
-                'bikeid': 'bike_id',
-                'usertype': 'user_type',
-                'start station id': 'start_station_id',
-                'birth year': 'birth_year',
-                'start station name': 'start_station_name',
-                'end station name': 'end_station_name',
-            })
-            dataframe = dataframe.drop(columns=[
-                'stoptime',
-                'start station latitude',
-                'start station longitude',
-                'end station id',
-                'end station latitude',
-                'end station longitude'
-            ])
-            dataframe = pd.merge(
-                dataframe, stations, left_on='start_station_id', right_index=True, how='left'
-            )
-            dataframes.append(dataframe)
-
-        dataframe = pd.concat(dataframes)
-        dataframe.to_csv('training.csv')
+            for dataframe in read_csv_chunks(path, chunk_size, max_memory):
+                dataframe = self._transform(dataframe, stations)
+                dataframe.to_csv(output, mode='a', header=row_count == 0)
+                row_count += len(dataframe)
+            logger.info(f'Training -- processed {path}, {row_count} rows written so far.')
+
+    def _process_parquet(self, directory: Path, chunk_size: int = None, max_memory: int = None):
+        # every source file is written to the year/month partitions of its trips, and is only
+        # rewritten when its size, modification time or the station data changed
+        manifest = PartitionManifest(directory)
+        stations = self._station_dataframe()
+        station_fingerprint = pd.util.hash_pandas_object(stations).sum()
+
+        paths = self._get_file_paths()
+        for key in set(manifest.entries) - {Path(path).name for path in paths}:
+            manifest.remove(key)
+            logger.info(f'Training -- removed the partitions of {key}, the file is gone.')
+
+        row_count = 0
+        for path in paths:
+            key = Path(path).name
+            stat = os.stat(path)
+            fingerprint = f'{stat.st_size}:{stat.st_mtime_ns}:{station_fingerprint}'
+            if manifest.is_current(key, fingerprint):
+                logger.info(f'Training -- {path} is up to date.')
+                continue
+
+            manifest.remove(key)
+            writers = {}
+            try:
+                for dataframe in read_csv_chunks(path, chunk_size, max_memory):
+                    dataframe = self._transform(dataframe, stations)
+                    months = [dataframe['start_time'].dt.year, dataframe['start_time'].dt.month]
+                    for (year, month), partition in dataframe.groupby(months):
+                        writer = writers.get((year, month))
+                        if writer is None:
+                            writer = writers[(year, month)] = PartitionWriter(
+                                partition_path(directory, year, month, f'{Path(path).stem}.parquet')
+                            )
+                        table = encode_strings(pa.Table.from_pandas(partition, preserve_index=False))
+                        writer.write(table if writer.schema is None else table.cast(writer.schema))
+                        row_count += len(partition)
+                for writer in writers.values():
+                    writer.close()
+            except Exception:
+                for writer in writers.values():
+                    writer.abort()
+                raise
+
+            manifest.update(key, fingerprint, [writer.path for writer in writers.values()])
+            logger.info(f'Training -- processed {path}, {row_count} rows written so far.')
+
+    @staticmethod
+    def _transform(dataframe: pd.DataFrame, stations: pd.DataFrame) -> pd.DataFrame:
+        dataframe = dataframe.rename(columns={
+            'tripduration': 'trip_duration',
+            'starttime': 'start_time',
+            'bikeid': 'bike_id',
+            'usertype': 'user_type',
+            'start station id': 'start_station_id',
+            'birth year': 'birth_year',
+            'start station name': 'start_station_name',
+            'end station name': 'end_station_name',
+            'start station latitude': 'start_station_latitude',
+            'start station longitude': 'start_station_longitude',
+            'end station latitude': 'end_station_latitude',
+            'end station longitude': 'end_station_longitude',
+        })
+        dataframe = dataframe.drop(columns=[
+            'stoptime',
+            'end station id',
+        ])
+        dataframe = pd.merge(
+            dataframe, stations, left_on='start_station_id', right_index=True, how='left'
+        )
+        # the coordinates are only needed for the distance feature
+        return build_features(dataframe).drop(columns=list(COORDINATE_COLUMNS))
@@ -0,0 +1,58 @@
+import tempfile
+
+from aiohttp import ClientResponseError, web
+from aiohttp.test_utils import AioHTTPTestCase
+
+from pipeline.gbfs import GBFSFeedCache
+
+FEED = {'ttl': 0, 'data': {'stations': [{'station_id': '3', 'name': 'Colleges of the Fenway'}]}}
+
+
+class GBFSFeedCacheTest(AioHTTPTestCase):
+    # a stand-in gbfs server answering with the queued statuses, 200 once the queue is empty
+    async def get_application(self) -> web.Application:
+        self.statuses = []
+        self.requests = []
+        app = web.Application()
+        app.router.add_get('/station_information.json', self.station_information)
+        return app
+
+    async def station_information(self, request: web.Request) -> web.Response:
+        self.requests.append(request)
+        status = self.statuses.pop(0) if self.statuses else 200
+        if status == 200:
+            return web.json_response(FEED, headers={'ETag': '"v1"'})
+        if status == 304:
+            return web.Response(status=304)
+        return web.json_response({'error': 'unavailable'}, status=status)
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache = GBFSFeedCache(self.cache_dir.name)
+        self.url = str(self.server.make_url('/station_information.json'))
+
+    async def asyncTearDown(self):
+        self.cache_dir.cleanup()
+        await super().asyncTearDown()
+
+    async def test_revalidates_with_etag(self):
+        self.assertEqual(await self.cache.fetch(self.client.session, self.url), FEED)
+        self.statuses.append(304)
+        self.assertEqual(await self.cache.fetch(self.client.session, self.url), FEED)
+        self.assertEqual(self.requests[-1].headers.get('If-None-Match'), '"v1"')
+
+    async def test_error_serves_the_cached_feed(self):
+        await self.cache.fetch(self.client.session, self.url)
+        self.statuses.append(503)
+        self.assertEqual(await self.cache.fetch(self.client.session, self.url), FEED)
+
+        # neither the memory nor the disk cache took the error body
+        self.assertEqual(GBFSFeedCache(self.cache_dir.name)._read(self.url).data, FEED)
+        self.assertEqual(await self.cache.fetch(self.client.session, self.url), FEED)
+
+    async def test_error_without_cached_feed_raises(self):
+        self.statuses.append(500)
+        with self.assertRaises(ClientResponseError):
+            await self.cache.fetch(self.client.session, self.url)
+        self.assertIsNone(self.cache._read(self.url))
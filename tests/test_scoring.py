@@ -0,0 +1,92 @@
+import os
+from datetime import datetime, timedelta
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import AioHTTPTestCase
+
+from benchmarks.stub_server import StubDataRobotServer
+from pipeline.backends import DataRobotBackend
+from pipeline.scoring import Scoring, ScoringFailed
+
+WINDOW = (datetime(2020, 1, 1, 8), datetime(2020, 1, 1, 8, 1))
+
+
+class StubScoring(Scoring):
+    # scores the trips of a list instead of the database, a trip leaves the list once it is saved
+    def __init__(self, *args, trip_count: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.trips = [{
+            'trip_id': trip_id,
+            'start_station_id': '3',
+            'start_time': (WINDOW[0] + timedelta(seconds=trip_id)).strftime('%Y-%m-%d %H:%M:%S.%f'),
+        } for trip_id in range(trip_count)]
+        self.saved = {}
+
+    def prediction_window(self) -> (datetime, datetime):
+        return self._window_start or WINDOW[0], WINDOW[1]
+
+    def select_prediction_payload(self, start_time_range=None, limit=100) -> [dict]:
+        return [trip for trip in self.trips if trip['trip_id'] not in self.saved][:limit]
+
+    def save_predictions(self, predicted_values: dict, start_time_range=None):
+        self.saved.update(predicted_values)
+
+
+class ScoringTest(AioHTTPTestCase):
+    async def get_application(self) -> web.Application:
+        self.stub = StubDataRobotServer(latency=0.02)
+        return self.stub.app
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        environment = mock.patch.dict(os.environ, {
+            'DATAROBOT_PRED_ENDPOINT': str(self.server.make_url('')).rstrip('/'),
+            'DATAROBOT_USERNAME': 'test',
+            'DATAROBOT_API_TOKEN': 'test',
+            'DATAROBOT_KEY': 'test',
+            'DEPLOYMENT_ID': 'test',
+        })
+        environment.start()
+        self.addCleanup(environment.stop)
+
+    def scoring(self, trip_count: int, request_size: int, max_in_flight: int = 4) -> StubScoring:
+        backend = DataRobotBackend(self.client.session, max_attempts=3, retry_delay=0.01)
+        return StubScoring(
+            self.client.session, backend, request_size=request_size, max_in_flight=max_in_flight,
+            trip_count=trip_count,
+        )
+
+    async def test_limits_requests_in_flight(self):
+        scoring = self.scoring(trip_count=40, request_size=2, max_in_flight=3)
+        self.assertEqual(await scoring.predict(limit=100), 40)
+        self.assertEqual(self.stub.prediction_requests, 20)
+        self.assertEqual(self.stub.max_in_flight, 3)
+        self.assertEqual(len(scoring.saved), 40)
+
+    async def test_retries_transient_errors(self):
+        scoring = self.scoring(trip_count=5, request_size=10)
+        self.stub.errors.extend([503, 429])
+        self.assertEqual(await scoring.predict(limit=100), 5)
+        self.assertEqual(self.stub.errors, [])
+        self.assertEqual(scoring._window_start, WINDOW[1] - timedelta(minutes=1))
+
+    async def test_partial_failure_keeps_the_window(self):
+        scoring = self.scoring(trip_count=4, request_size=2, max_in_flight=1)
+        self.stub.errors.append(400)
+        self.assertEqual(await scoring.predict(limit=100), 2)
+        self.assertIsNone(scoring._window_start)
+
+        # the rejected trips are sent again from the same window start, which then moves on
+        self.assertEqual(await scoring.predict(limit=100), 2)
+        self.assertEqual(len(scoring.saved), 4)
+        self.assertEqual(scoring._window_start, WINDOW[1] - timedelta(minutes=1))
+
+    async def test_rejected_page_raises(self):
+        scoring = self.scoring(trip_count=2, request_size=2)
+        self.stub.errors.append(400)
+        with self.assertRaises(ScoringFailed) as raised:
+            await scoring.predict(limit=100)
+        self.assertEqual(raised.exception.failed_count, 2)
+        self.assertEqual(self.stub.prediction_requests, 0)
+        self.assertIsNone(scoring._window_start)